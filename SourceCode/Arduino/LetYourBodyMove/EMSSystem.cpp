@@ -190,7 +190,15 @@ uint8_t EMSSystem::check() {
 void EMSSystem::doCommand(String *command) {
 	if (command->length() > 0) {
 		if (command->indexOf(ACTION) != -1) {
-			doActionCommand(command);
+			// One write may carry several action commands, each terminated by ACTION
+			int start = 0;
+			int end = command->indexOf(ACTION);
+			while (end != -1) {
+				String single = command->substring(start, end + 1);
+				doActionCommand(&single);
+				start = end + 1;
+				end = command->indexOf(ACTION, start);
+			}
 		} else if (command->charAt(0) == OPTION) {
 			setOption(command);
 		} else {
@@ -140,6 +140,13 @@ void Rn4020BTLe::init(String bluetoothName) {
 	debug_print(F("\t\tSet new private service value: "));
 	print_response();
 
+	// Read-only features characteristic, created after the one above so that keeps handle 001C.
+	// "454d532d46656174757265732d424c45" is "EMS-Features-BLE" in ASCII, its value is set in start_communication()
+	serial->println(F("PC,454d532d46656174757265732d424c45,02,01"));
+	delay(250);
+	debug_print(F("\t\tSet features characteristic: "));
+	print_response();
+
 	serial->println(F("SB,3"));
 	delay(150);
 	debug_print(F("\t\tSet baudrate: "));
@@ -156,6 +163,9 @@ void Rn4020BTLe::init(String bluetoothName) {
 
 void Rn4020BTLe::start_communication() {
 	serial->begin(38400);
+	// Feature bits: 0x02, EMSSystem::doCommand applies every command of a write
+	serial->println(F("SUW,454d532d46656174757265732d424c45,02"));
+	delay(100);
 }
 
 bool Rn4020BTLe::print_response() {
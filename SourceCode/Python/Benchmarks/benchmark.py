@@ -0,0 +1,185 @@
+import asyncio
+import csv
+import json
+import time
+
+from SharedFiles import commands, emulator
+from SharedFiles.bluetooth import BluetoothHandler
+from SharedFiles.channels import ChannelArray
+from SharedFiles.framing import StateUpdate, as_commands
+from SharedFiles.lanes import STATE, STOP
+from SharedFiles.timeline import Timeline
+from StudyTests.tests import zone_events, flow_events
+from MouseInputApp.app import gesture_events
+
+# Captured (point, seconds) tuples used as a representative MouseInputApp gesture
+SAMPLE_GESTURE = [("P1", 0.8), ("P2", 0.3), ("P4", 1.2), ("P6", 0.6), ("P7", 1.5)]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+async def make_handler(address, latency_ms, jitter_ms, loss, binary_frames=False, **handler_options):
+    client = emulator.EmulatedClient(address, device=emulator.EMSDevice(), latency=latency_ms / 1000,
+                                     jitter=jitter_ms / 1000, loss=loss, seed=1, binary_frames=binary_frames)
+    handler = BluetoothHandler(address, client=client, use_cache=False, **handler_options)
+    await handler.connect()
+    return handler
+
+
+async def bench_throughput(handler, count):
+    """Commands per second with producers that never wait for each other."""
+    payloads = [commands.command(i % 2, i % 100 + 1, 500) for i in range(count)]
+    writes_before = handler.client.writes
+    start = time.perf_counter()
+    await asyncio.gather(*(handler.send(payload) for payload in payloads))
+    elapsed = time.perf_counter() - start
+    return {
+        "commands": count,
+        "seconds": elapsed,
+        "commands_per_sec": count / elapsed,
+        "gatt_writes": handler.client.writes - writes_before,
+    }
+
+
+async def bench_latency(handler, count, interval_ms):
+    """Delay from calling send to write completion, one command every interval_ms."""
+    delays = []
+
+    async def timed(command):
+        start = time.perf_counter()
+        await handler.send(command)
+        delays.append((time.perf_counter() - start) * 1000)
+
+    tasks = []
+    for i in range(count):
+        tasks.append(asyncio.ensure_future(timed(commands.command(i % 2, 50, 500))))
+        await asyncio.sleep(interval_ms / 1000)
+    await asyncio.gather(*tasks)
+    return summarize(delays)
+
+
+async def bench_sequence(handler, name, events, time_scale):
+    """Difference between intended and device-observed time of every command."""
+    device = handler.client.device
+    events = [(offset * time_scale, command) for offset, command in events]
+    first = len(device.commands)
+    writes_before = handler.client.writes
+    timeline = Timeline(events, handler.send)
+    start = device.clock()
+    await timeline.run()
+
+    # Coalesced commands arrive in one write, so match commands by their position
+    received = []
+    for at, payload in device.commands[first:]:
+        received.extend((at, part + "G") for part in payload.split("G")[:-1])
+    expected = [offset for offset, command in timeline.events for _ in as_commands(command)]
+    errors = [at - start - offset for offset, (at, _) in zip(expected, received)]
+    result = summarize([abs(e) for e in errors])
+    result.update({
+        "sequence": name,
+        "events": len(expected),
+        "received": len(received),
+        "writes": handler.client.writes - writes_before,
+        "scheduler_jitter_max_ms": timeline.max_jitter_ms(),
+    })
+    return result
+
+
+async def bench_stop(handler, count, burst, priority):
+    """Delay from a stop request to its write on the device, with a burst of stimulation queued ahead of it."""
+    device = handler.client.device
+    delays = []
+    superseded_before = handler.superseded
+    for _ in range(count):
+        stimulation = [asyncio.ensure_future(handler.send(commands.command(j % 2, j % 100 + 1, 500)))
+                       for j in range(burst)]
+        # Let the burst reach the queue first
+        await asyncio.sleep(0)
+        first = len(device.commands)
+        start = device.clock()
+        await handler.send(StateUpdate.off(), priority=priority)
+        at = next(at for at, payload in device.commands[first:] if "C0I0T0G" in payload)
+        delays.append(at - start)
+        await asyncio.gather(*stimulation)
+    result = summarize(delays)
+    result["superseded"] = handler.superseded - superseded_before
+    return result
+
+
+async def run_benchmarks(count=2000, latency_count=500, interval_ms=5.0, time_scale=0.1,
+                         latency_ms=0.0, jitter_ms=0.0, loss=0.0, coalesce_window=0.005, response=True,
+                         binary_frames=False):
+    # Every command has to reach the device to be measured, so nothing is elided
+    options = {"coalesce_window": coalesce_window, "response": response, "elide_redundant": False}
+    handler = await make_handler("EMU:bench", latency_ms, jitter_ms, loss, binary_frames, **options)
+    try:
+        results = {
+            "config": {
+                "count": count, "latency_count": latency_count, "interval_ms": interval_ms,
+                "time_scale": time_scale, "latency_ms": latency_ms, "jitter_ms": jitter_ms,
+                "loss": loss, "coalesce_window": coalesce_window, "response": response,
+                "binary_frames": binary_frames,
+            },
+            "throughput": await bench_throughput(handler, count),
+            "latency_ms": await bench_latency(handler, latency_count, interval_ms),
+            "sequences_ms": [],
+        }
+        sequences = [("zone" + str(zone), zone_events(zone, 100, 100)) for zone in (1, 2, 3)]
+        sequences += [("flow" + str(flow), flow_events(flow, 100, 100)) for flow in (1, 2)]
+        sequences.append(("gesture", gesture_events(SAMPLE_GESTURE, ChannelArray(2, 100))))
+        for name, events in sequences:
+            results["sequences_ms"].append(await bench_sequence(handler, name, events, time_scale))
+    finally:
+        await handler.disconnect()
+
+    # Stops are measured on a slower link, by default one typical BLE connection interval per write
+    handler = await make_handler("EMU:stop", latency_ms or 7.5, jitter_ms, 0.0, **options)
+    try:
+        results["stop_ms"] = {
+            "priority_lanes": await bench_stop(handler, 20, 32, STOP),
+            "fifo": await bench_stop(handler, 20, 32, STATE),
+        }
+    finally:
+        await handler.disconnect()
+    return results
+
+
+def write_json(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def write_csv(results, path):
+    """One row per metric: benchmark, name, metric, value."""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["benchmark", "name", "metric", "value"])
+        for metric, value in results["throughput"].items():
+            writer.writerow(["throughput", "", metric, value])
+        for metric, value in results["latency_ms"].items():
+            writer.writerow(["latency_ms", "", metric, value])
+        for sequence in results["sequences_ms"]:
+            for metric, value in sequence.items():
+                if metric != "sequence":
+                    writer.writerow(["sequences_ms", sequence["sequence"], metric, value])
+        for name, stop in results["stop_ms"].items():
+            for metric, value in stop.items():
+                writer.writerow(["stop_ms", name, metric, value])
@@ -0,0 +1,45 @@
+import argparse
+import asyncio
+import json
+
+from Benchmarks.benchmark import run_benchmarks, write_json, write_csv
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the BLE command path against the toolkit emulator.")
+    parser.add_argument("--count", type=int, default=2000, help="commands for the throughput run")
+    parser.add_argument("--latency-count", type=int, default=500, help="commands for the latency run")
+    parser.add_argument("--interval-ms", type=float, default=5.0, help="spacing of commands in the latency run")
+    parser.add_argument("--time-scale", type=float, default=0.1, help="scale applied to sequence offsets")
+    parser.add_argument("--link-latency-ms", type=float, default=0.0, help="emulated write latency")
+    parser.add_argument("--link-jitter-ms", type=float, default=0.0, help="emulated write jitter")
+    parser.add_argument("--loss", type=float, default=0.0, help="emulated write loss probability")
+    parser.add_argument("--coalesce-ms", type=float, default=5.0, help="BluetoothHandler coalesce window")
+    parser.add_argument("--no-response", action="store_true", help="write without response")
+    parser.add_argument("--binary", action="store_true", help="emulated device accepts binary state frames")
+    parser.add_argument("--json", help="write results as JSON to this file")
+    parser.add_argument("--csv", help="write results as CSV to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run_benchmarks(
+        count=args.count,
+        latency_count=args.latency_count,
+        interval_ms=args.interval_ms,
+        time_scale=args.time_scale,
+        latency_ms=args.link_latency_ms,
+        jitter_ms=args.link_jitter_ms,
+        loss=args.loss,
+        coalesce_window=args.coalesce_ms / 1000,
+        response=not args.no_response,
+        binary_frames=args.binary,
+    ))
+
+    if args.json:
+        write_json(results, args.json)
+    if args.csv:
+        write_csv(results, args.csv)
+    if not args.json and not args.csv:
+        print(json.dumps(results, indent=2))
@@ -1,25 +1,66 @@
-import asyncio
+from SharedFiles import startup
+import argparse
+import os
 
 from CalibrationApp.calibration import calibrate
-from SharedFiles.bluetooth import BluetoothHandler
+from CalibrationApp.staircase import ENGINES, ScriptedResponder, convergence
+from SharedFiles import emulator, runtime
+from SharedFiles.fanout import create_handler
 
-# Replace with Toolkit address
-DEVICE_ADDRESS = "DFA6C7B9-4E47-88B8-0E82-3A420A1C3FDD"
+startup.mark("imports")
 
+# Replace with Toolkit address, or set EMS_DEVICE_ADDRESS (e.g. "EMU:0" for the emulator).
+# Several comma separated addresses drive all toolkits at once.
+DEVICE_ADDRESS = os.environ.get("EMS_DEVICE_ADDRESS", "DFA6C7B9-4E47-88B8-0E82-3A420A1C3FDD")
 
-async def main():
-    handler = BluetoothHandler(DEVICE_ADDRESS)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Calibrate the EMS intensities of a participant.")
+    parser.add_argument("--participant", help="store the result for this participant")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="binary", help="threshold search")
+    parser.add_argument("--scripted", metavar="T1,T2",
+                        help="run headless against the emulator, answering as a participant with these thresholds")
+    parser.add_argument("--spread", type=float, default=0.0, help="answer noise of the scripted participant")
+    parser.add_argument("--lapse", type=float, default=0.0,
+                        help="share of flipped answers of the scripted participant")
+    parser.add_argument("--check", action="store_true",
+                        help="only check how well every engine converges with scripted answers, no device needed")
+    parser.add_argument("--seed", type=int, help="seed for the trial order and scripted answers")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.check:
+        for engine in sorted(ENGINES):
+            print(f"{engine}: {convergence(engine, spread=args.spread, lapse=args.lapse, seed=args.seed or 0)}")
+        return
+
+    respond = None
+    address = DEVICE_ADDRESS
+    if args.scripted:
+        address = "EMU:calibration"
+    handler = create_handler(address)
 
     try:
-        print(f"Connecting to {DEVICE_ADDRESS}...")
-        await handler.connect(timeout=10.0)
-        print(f"Connected. Writable characteristic: {handler.characteristic_uuid}")
+        print(f"Connecting to {address}...")
+        runtime.run(handler.connect(timeout=10.0))
+        print(f"Connected to {address}.")
+        startup.mark("connect")
+        startup.report()
 
-        calibrate(handler)
+        if args.scripted:
+            thresholds = dict(enumerate(int(t) for t in args.scripted.split(",")))
+            respond = ScriptedResponder(thresholds, args.spread, args.seed, emulator.get_device(address), args.lapse)
+        calibrate(handler, args.participant, args.engine, respond, args.seed)
 
     except Exception as e:
         print("Connection Failed: " + str(e))
+    finally:
+        print("Connection stats: " + str(handler.stats()))
+        runtime.run(handler.disconnect(), timeout=5.0)
+        runtime.shutdown()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -0,0 +1,225 @@
+"""Adaptive threshold searches for the calibration.
+
+An engine proposes the next intensity (next_intensity), is told whether the
+participant noticed it (record) and reports the threshold once done. Both
+engines work on whole percent steps between low and high.
+"""
+import math
+import random
+
+
+class BinarySearch:
+    """Smallest noticeable intensity by bisection, about 9 trials for 1..100.
+
+    Once the bisection has converged on t, t is presented again and has to be
+    noticed, and t - 1 has to be missed. A failed check means an earlier answer
+    was wrong: the search reopens a bracket next to t and bisects again. The
+    bracket is twice as wide after every failed check in the same direction,
+    so a wrong answer far from the threshold is recovered from quickly, and
+    narrow again when the direction changes, as it does for noisy answers
+    close to the threshold. It stops after max_trials.
+    """
+
+    MIN_WIDTH = 4
+
+    def __init__(self, low=1, high=100, max_trials=30):
+        self.low = low
+        self.high = high
+        self.max_trials = max_trials
+        self.trials = 0
+        # The threshold lies in [lo, hi], hi = high + 1 means nothing was noticed yet
+        self.lo = low
+        self.hi = high + 1
+        # (intensity, expected answer) still to check once the bisection has converged
+        self._checks = []
+        self._confirmed = False
+        self._width = self.MIN_WIDTH
+        self._last_failed = None
+
+    @property
+    def done(self):
+        return self._confirmed or self.trials >= self.max_trials
+
+    def next_intensity(self):
+        if self._checks:
+            return self._checks[0][0]
+        return (self.lo + self.hi) // 2
+
+    def record(self, intensity, noticed):
+        self.trials += 1
+        if self._checks:
+            self._check(noticed)
+            return
+        if noticed:
+            self.hi = intensity
+        else:
+            self.lo = intensity + 1
+        if self.lo >= self.hi:
+            t = self.hi
+            self._checks = [(i, i == t) for i in (t, t - 1) if self.low <= i <= self.high]
+
+    def _check(self, noticed):
+        intensity, expected = self._checks.pop(0)
+        if noticed == expected:
+            self._confirmed = not self._checks
+            return
+        self._checks = []
+        self._width = self._width * 2 if expected == self._last_failed else self.MIN_WIDTH
+        self._last_failed = expected
+        if expected:
+            # Missed at the threshold, it lies above
+            self.lo = intensity + 1
+            self.hi = min(self.high + 1, intensity + self._width)
+        else:
+            # Noticed below the threshold, it lies at or below intensity
+            self.hi = intensity
+            self.lo = max(self.low, intensity - self._width)
+        if self.lo >= self.hi:
+            t = self.hi
+            self._checks = [(i, i == t) for i in (t, t - 1) if self.low <= i <= self.high]
+
+    @property
+    def threshold(self):
+        if not self.done:
+            return None
+        return self.hi if self.hi <= self.high else None
+
+
+class UpDownStaircase:
+    """1-up/1-down staircase that halves its step on every reversal.
+
+    Goes down after a noticed stimulus and up otherwise, and stops after
+    reversals reversals or max_trials trials. The threshold is the mean of the
+    last reversal intensities, the 50 % point of the psychometric function.
+    Needs more trials than BinarySearch but copes with noisy answers near the
+    threshold.
+    """
+
+    def __init__(self, low=1, high=100, start=50, step=16, reversals=6, max_trials=30):
+        self.low = low
+        self.high = high
+        self.intensity = start
+        self.step = step
+        self.reversals = reversals
+        self.max_trials = max_trials
+        self.trials = 0
+        self.reversal_intensities = []
+        self._last_noticed = None
+        self._misses_at_high = 0
+        self._hits_at_low = 0
+
+    @property
+    def done(self):
+        return (len(self.reversal_intensities) >= self.reversals or self.trials >= self.max_trials
+                or self._misses_at_high >= 2 or self._hits_at_low >= 2)
+
+    def next_intensity(self):
+        return self.intensity
+
+    def record(self, intensity, noticed):
+        self.trials += 1
+        if self._last_noticed is not None and noticed != self._last_noticed:
+            self.reversal_intensities.append(intensity)
+            self.step = max(1, self.step // 2)
+        self._last_noticed = noticed
+        if not noticed and intensity >= self.high:
+            self._misses_at_high += 1
+        if noticed and intensity <= self.low:
+            self._hits_at_low += 1
+        step = -self.step if noticed else self.step
+        self.intensity = min(self.high, max(self.low, intensity + step))
+
+    @property
+    def threshold(self):
+        last = self.reversal_intensities[-4:]
+        if not last:
+            # Noticed even at the lowest intensity
+            return self.low if self._hits_at_low >= 2 else None
+        return int(round(sum(last) / len(last)))
+
+
+ENGINES = {"binary": BinarySearch, "staircase": UpDownStaircase}
+
+
+class ScriptedResponder:
+    """Answers like a participant with fixed thresholds ({channel: intensity}).
+
+    Thresholds are commanded intensities, the same scale the engines search.
+    With spread > 0 answers follow a logistic psychometric function around the
+    threshold instead of a hard step, and lapse is the share of answers that
+    are flipped regardless of the intensity. device, e.g. an emulator
+    EMSDevice, makes the stimulus count only while the channel is actually on.
+    """
+
+    def __init__(self, thresholds, spread=0.0, seed=None, device=None, lapse=0.0):
+        self.thresholds = dict(thresholds)
+        self.spread = spread
+        self.lapse = lapse
+        self.random = random.Random(seed)
+        self.device = device
+
+    def __call__(self, channel, intensity):
+        if self.device is not None and not self.device.running()[channel]:
+            noticed = False
+        else:
+            margin = intensity - self.thresholds[channel]
+            if self.spread <= 0:
+                noticed = margin >= 0
+            else:
+                noticed = self.random.random() < 1 / (1 + math.exp(-margin / self.spread))
+        if self.lapse > 0 and self.random.random() < self.lapse:
+            return not noticed
+        return noticed
+
+
+def run_interleaved(engines, present, respond, release=None, seed=None):
+    """Runs one engine per channel, trials of the channels interleaved in random order.
+
+    present(channel, intensity) stimulates, respond(channel, intensity) returns
+    whether it was noticed and release(channel) ends the stimulation after the
+    answer. Returns ({channel: threshold}, trials).
+    """
+    rng = random.Random(seed)
+    trials = 0
+    while True:
+        pending = [channel for channel, engine in engines.items() if not engine.done]
+        if not pending:
+            break
+        rng.shuffle(pending)
+        for channel in pending:
+            engine = engines[channel]
+            intensity = engine.next_intensity()
+            present(channel, intensity)
+            engine.record(intensity, respond(channel, intensity))
+            if release is not None:
+                release(channel)
+            trials += 1
+    return {channel: engine.threshold for channel, engine in engines.items()}, trials
+
+
+def convergence(engine="binary", runs=500, spread=0.0, lapse=0.0, seed=0, low=1, high=100):
+    """Scripted check of how close engine gets to random thresholds, without a device.
+
+    Every run draws a threshold in low..high and answers with a
+    ScriptedResponder, the same seed gives the same result. Returns the
+    absolute error statistics in percent, the share of runs within 2 % of the
+    threshold and the mean number of trials.
+    """
+    rng = random.Random(seed)
+    errors, trials = [], 0
+    for _ in range(runs):
+        threshold = rng.randint(low, high)
+        respond = ScriptedResponder({0: threshold}, spread, rng.random(), lapse=lapse)
+        found, count = run_interleaved({0: ENGINES[engine](low, high)}, lambda channel, intensity: None,
+                                       respond, seed=rng.random())
+        trials += count
+        errors.append(abs(found[0] - threshold) if found[0] is not None else high - low)
+    errors.sort()
+    return {
+        "runs": runs,
+        "mean_error": round(sum(errors) / runs, 2),
+        "p90_error": errors[int(runs * 0.9)],
+        "max_error": errors[-1],
+        "within_2": round(sum(e <= 2 for e in errors) / runs, 3),
+        "mean_trials": round(trials / runs, 1),
+    }
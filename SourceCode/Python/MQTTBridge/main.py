@@ -0,0 +1,46 @@
+from SharedFiles import startup
+import os
+import time
+
+from SharedFiles import runtime
+from SharedFiles.bridge import MQTTBridge
+from SharedFiles.fanout import create_handler
+
+startup.mark("imports")
+
+# Replace with Toolkit address, or set EMS_DEVICE_ADDRESS (e.g. "EMU:0" for the emulator)
+DEVICE_ADDRESS = os.environ.get("EMS_DEVICE_ADDRESS", "DFA6C7B9-4E47-88B8-0E82-3A420A1C3FDD")
+BROKER_ADDRESS = os.environ.get("EMS_MQTT_BROKER", "localhost")
+TOPIC = os.environ.get("EMS_MQTT_TOPIC", "ems/commands")
+
+
+def main():
+    handler = create_handler(DEVICE_ADDRESS)
+    bridge = None
+
+    try:
+        print(f"Connecting to {DEVICE_ADDRESS}...")
+        runtime.run(handler.connect(timeout=10.0))
+        startup.mark("connect")
+        bridge = MQTTBridge(handler, BROKER_ADDRESS, TOPIC)
+        bridge.start()
+        startup.mark("mqtt")
+        startup.report()
+        print(f"Forwarding {TOPIC} from {BROKER_ADDRESS}. Press Ctrl+C to stop.")
+        while True:
+            time.sleep(10)
+            print("Bridge stats: " + str(bridge.stats()))
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print("Bridge Failed: " + str(e))
+    finally:
+        if bridge:
+            bridge.stop()
+        runtime.run(handler.disconnect(), timeout=5.0)
+        runtime.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,85 @@
 import tkinter as tk
-import math
 import time
-import asyncio
-from time import sleep
+from collections import deque
 
-from SharedFiles.bluetooth import BluetoothHandler, scan_devices
+from SharedFiles import commands, device_cache
+from SharedFiles.log import get_logger
+from MouseInputApp.targets import NearestTargetIndex, TargetLayout
+from MouseInputApp.gesture import Gesture, MotionThrottle
+from MouseInputApp.render import CanvasRenderer
 import threading
 
+log = get_logger("app")
+
+# Not needed to show the window, imported by App.preload once it is up
+DEFERRED_MODULES = ("SharedFiles.runtime", "SharedFiles.bluetooth", "SharedFiles.supervisor",
+                    "SharedFiles.playback", "SharedFiles.metrics", "SharedFiles.patterns", "SharedFiles.channels")
+
+
+# Every single-channel point fades out over this long, overlapping the next point
+FADE_MS = 500
+
+
+def gesture_events(points, intensities, channels=None):
+    """Timeline events for captured (point, seconds) tuples.
+
+    intensities is the ChannelArray of the connected rig.
+    channels maps each target to the channels it stimulates, by default the
+    mapping of the original P1-P7 layout.
+    """
+    from SharedFiles import patterns
+
+    channels = channels or TargetLayout.default().channels
+    durations = []
+    for point in points:
+        if point[0] not in channels:
+            raise ValueError(f"Error for {point[0]}")
+        durations.append(int(round(point[1] * 1000, 0)))
+    # Each point starts where the previous one begins to fade
+    starts = [0]
+    for duration in durations:
+        starts.append(starts[-1] + (duration - FADE_MS if duration > FADE_MS else 0))
+
+    events = []
+    for i, point in enumerate(points):
+        targets = channels[point[0]]
+        offset = starts[i]
+        # Longer signals are cut to the firmware maximum anyway
+        signal = min(durations[i], commands.MAX_DURATION)
+
+        if len(targets) == 1:
+            channel = targets[0]
+            events.append((offset, commands.command(channel, intensities[channel], signal)))
+        else:
+            events.append((offset, intensities.update(durations=signal, channels=targets)))
+
+        # "Fade Out" ramp over FADE_MS, not used for points between the channels.
+        # If a later point starting within the ramp stimulates the same channel, the ramp and
+        # the off at its end would override that point, so the channel is only shortened then.
+        if len(targets) == 1:
+            offset = starts[i + 1]
+            overlapping = any(channel in channels[later[0]]
+                              for later, start in zip(points[i + 1:], starts[i + 1:]) if start < offset + FADE_MS)
+            if overlapping:
+                events.append((offset, commands.command(channel, intensities[channel], FADE_MS)))
+            else:
+                events += patterns.compile_pattern(
+                    patterns.fade_out(channel, FADE_MS), {channel: intensities[channel]}, offset_ms=offset)
+
+    return events
+
+
 class App:
+    # Motion events closer together than this are skipped
+    MOTION_INTERVAL_MS = 15
+    # Zone visits shorter than this are treated as border flicker and dropped on confirm
+    FLICKER_MS = 80
+    # The log box keeps the last LOG_LINES lines and is updated every LOG_FLUSH_MS
+    LOG_LINES = 200
+    LOG_FLUSH_MS = 100
+    # The canvas is redrawn at most this often, with all changes since the last frame
+    RENDER_FPS = 60
+
     def __init__(self, root):
         self.root = root
         self.root.title("Mouse Capture")
@@ -17,47 +89,48 @@ class App:
         self.ble_handler = None
         self.connected = False
         self.devices = []
+        self.scanned = False
         self.selected_device_var = tk.StringVar()
         self.selected_device_var.set("Waiting for Scan...")
 
-        # Async loop
-        self.bg_loop = None
+        # EMS intensities, a ChannelArray with one per channel set on connect
+        self.intensities = None
 
-        # Standard EMS intensities
-        self.channel1_intensity = 100
-        self.channel2_intensity = 100
+        # Gesture playback, created on connect
+        self.player = None
+        self.gesture_count = 0
 
         # Popup tracking
         self.loading_popup = None
 
+        # Log lines waiting for the next flush into the log box, may be filled from any thread
+        self.pending_log = deque(maxlen=self.LOG_LINES)
+
         # Mouse tracking state
         self.mouse_down = False
         self.active_point = None
         self.active_point_start_time = None
-        self.captured_points = []
-
-        # Target points
-        self.points = {
-            "P1": (100, 50),
-            "P2": (200, 50),
-            "P3": (300, 50),
-            "P4": (200, 150),
-            "P5": (100, 250),
-            "P6": (200, 250),
-            "P7": (300, 250),
-        }
+        self.motion_throttle = MotionThrottle(self.MOTION_INTERVAL_MS)
+
+        # Target points, loaded from targets.json (or EMS_TARGET_LAYOUT)
+        self.layout = TargetLayout.load()
+        self.points = self.layout.points
+        self.target_index = NearestTargetIndex(self.points, self.layout.width, self.layout.height)
+        self.captured = Gesture(self.points)
 
         # Build the UI (after state setup)
         self._build_ui()
+        self.load_cached_devices()
+        self.root.after_idle(self.preload)
 
-        # Create BLE message loop
-        self.bg_loop = asyncio.new_event_loop()
+    def preload(self):
+        """Imports the BLE, runtime and NumPy modules in the background, so the first click does not wait."""
+        def _import():
+            import importlib
+            for module in DEFERRED_MODULES:
+                importlib.import_module(module)
 
-        def _run():
-            asyncio.set_event_loop(self.bg_loop)
-            self.bg_loop.run_forever()
-
-        threading.Thread(target=_run, daemon=True).start()
+        threading.Thread(target=_import, name="ems-preload", daemon=True).start()
 
     def _build_ui(self):
         top_frame = tk.Frame(self.root)
@@ -68,18 +141,24 @@ class App:
         self.device_menu.pack(side=tk.LEFT, padx=5)
         tk.Button(top_frame, text="Connect", command=self.connect_ble).pack(side=tk.LEFT)
 
-        self.canvas = tk.Canvas(self.root, bg="white", height=300)
+        self.canvas = tk.Canvas(self.root, bg="white", height=self.layout.height)
         self.canvas.pack(fill=tk.X)
+        self.renderer = CanvasRenderer(self.canvas, fps=self.RENDER_FPS)
+
+        button_frame = tk.Frame(self.root)
+        button_frame.pack(pady=10)
 
-        self.confirm_button = tk.Button(self.root, text="Confirm Input", command=self.on_confirm)
-        self.confirm_button.pack(pady=10)
+        self.confirm_button = tk.Button(button_frame, text="Confirm Input", command=self.on_confirm)
+        self.confirm_button.pack(side=tk.LEFT, padx=5)
+        self.stop_button = tk.Button(button_frame, text="Stop", command=self.on_stop)
+        self.stop_button.pack(side=tk.LEFT, padx=5)
 
         self.log_box = tk.Text(self.root, height=5, state="disabled")
         self.log_box.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        self.root.after(self.LOG_FLUSH_MS, self.flush_log)
 
-        # Draw points on canvas
-        for x, y in self.points.values():
-            self.canvas.create_oval(x - 5, y - 5, x + 5, y + 5, fill="gray")
+        self.draw_targets()
+        self.renderer.start()
 
         # Bind mouse events
         self.canvas.bind("<ButtonPress-1>", self.on_mouse_down)
@@ -90,47 +169,74 @@ class App:
 
     def on_mouse_down(self, event):
         self.mouse_down = True
+        self.renderer.clear_trail()
+        self.renderer.add_point(event.x, event.y)
         self.check_nearest_point(event.x, event.y)
 
     def on_mouse_up(self, event):
         self.mouse_down = False
+        # The throttle may have skipped the last motion events, the release point counts as visited
+        self.check_nearest_point(event.x, event.y)
         self.finalize_current_point()
         self.active_point = None
         self.active_point_start_time = None
+        self.renderer.set_active(None)
 
     def on_mouse_move(self, event):
-        if self.mouse_down:
+        if not self.mouse_down:
+            return
+        # Every event extends the trail, it is drawn with the next frame
+        self.renderer.add_point(event.x, event.y)
+        if self.motion_throttle.accept():
             self.check_nearest_point(event.x, event.y)
 
-    def check_nearest_point(self, x, y):
-        min_dist = float('inf')
-        closest_label = None
+    def draw_targets(self):
+        self.renderer.set_targets(self.points)
 
-        for label, (px, py) in self.points.items():
-            dist = math.hypot(x - px, y - py)
-            if dist < min_dist:
-                min_dist = dist
-                closest_label = label
+    def set_layout(self, layout: TargetLayout):
+        # The lookup raster is only rebuilt here, not per motion event
+        self.layout = layout
+        self.points = layout.points
+        self.target_index = NearestTargetIndex(self.points, layout.width, layout.height)
+        self.captured = Gesture(self.points)
+        self.active_point = None
+        self.renderer.set_active(None)
+        self.draw_targets()
+
+    def check_nearest_point(self, x, y):
+        closest_label = self.target_index.nearest(x, y)
 
         if closest_label != self.active_point:
             self.finalize_current_point()
             self.active_point = closest_label
-            self.active_point_start_time = time.time()
+            self.active_point_start_time = time.monotonic()
+            self.renderer.set_active(closest_label)
             self.log(f"Entered point: {closest_label}")
 
     def finalize_current_point(self):
         if self.active_point and self.active_point_start_time:
-            duration = time.time() - self.active_point_start_time
-            duration = max(0.1, round(duration, 1))
-            self.captured_points.append((self.active_point, duration))
-            self.log(f"Captured: {self.active_point} for {duration} seconds")
+            duration_ms = (time.monotonic() - self.active_point_start_time) * 1000
+            self.active_point_start_time = None
+            self.captured.add(self.active_point, duration_ms)
+            self.log(f"Captured: {self.active_point} for {duration_ms / 1000:.1f} seconds")
 
     def log(self, message):
-        print(message)
-        self.log_box.configure(state="normal")
-        self.log_box.insert(tk.END, message + "\n")
-        self.log_box.configure(state="disabled")
-        self.log_box.see(tk.END)
+        """Thread safe, the log box shows the message on the next flush."""
+        log.info(message)
+        self.pending_log.append(message)
+
+    def flush_log(self):
+        if self.pending_log:
+            lines = [self.pending_log.popleft() for _ in range(len(self.pending_log))]
+            self.log_box.configure(state="normal")
+            self.log_box.insert(tk.END, "\n".join(lines) + "\n")
+            # Drop the oldest lines, the text widget gets slower the more it holds
+            excess = int(self.log_box.index("end-1c").split(".")[0]) - 1 - self.LOG_LINES
+            if excess > 0:
+                self.log_box.delete("1.0", f"{excess + 1}.0")
+            self.log_box.configure(state="disabled")
+            self.log_box.see(tk.END)
+        self.root.after(self.LOG_FLUSH_MS, self.flush_log)
 
     def connect_ble(self):
         def async_connect():
@@ -145,44 +251,80 @@ class App:
                 self.log("Invalid device address.")
                 return
 
+            from SharedFiles import patterns, runtime
+            from SharedFiles.bluetooth import BluetoothHandler
+            from SharedFiles.channels import ChannelArray
+            from SharedFiles.playback import Player
+            from SharedFiles.supervisor import ConnectionSupervisor
+
             try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                handler = BluetoothHandler(address)
-                loop.run_until_complete(handler.connect(timeout=10.0))
+                handler = ConnectionSupervisor(BluetoothHandler(address))
+                runtime.run(handler.connect(timeout=10.0))
                 self.ble_handler = handler
+                # Only the messages about whole gestures go to the log box, the per-command ones are DEBUG logging
+                self.player = Player(handler.send, on_progress=self.log)
                 self.connected = True
                 self.log(f"Connected to {address}")
-                # Do calibration using console
-                self.log("Please enter the channel intensities from the calibration phase in the terminal window.")
-                self.channel1_intensity = int(input("Channel 1:"))
-                self.channel2_intensity = int(input("Channel 2:"))
-                self.log("Intensities set!")
-                # self.channel1_intensity, self.channel2_intensity = calibrate(self.ble_handler)
             except Exception as e:
                 self.connected = False
                 self.log("Connection Failed: " + str(e))
+                if any(address == cached for _, cached in self.devices) and not self.scanned:
+                    self.log("Cached device not reachable, scanning...")
+                    self.root.after(0, self.scan_devices)
+                return
+
+            # Do calibration using console
+            self.log("Please enter the channel intensities from the calibration phase in the terminal window.")
+            intensities = ChannelArray()
+            for channel in range(len(intensities)):
+                intensities[channel] = self.ask_intensity(channel)
+            for channel in range(len(intensities)):
+                patterns.compile_pattern(patterns.fade_out(channel), intensities.as_dict())
+            self.intensities = intensities
+            self.log("Intensities set!")
+            # self.intensities = ChannelArray.from_calibration(dict(enumerate(calibrate(self.ble_handler))))
 
         threading.Thread(target=async_connect, daemon=True).start()
 
+    def ask_intensity(self, channel):
+        """Asks on the console until the intensity of channel is a whole number in 1..MAX_INTENSITY."""
+        while True:
+            answer = input(f"Channel {channel + 1}:").strip()
+            if answer.isdigit() and 1 <= int(answer) <= commands.MAX_INTENSITY:
+                return int(answer)
+            self.log(f"Invalid intensity {answer!r}, enter a number from 1 to {commands.MAX_INTENSITY}.")
+
+    def load_cached_devices(self):
+        # Known toolkits are offered right away, a scan is only needed for new ones
+        cached = device_cache.cached_devices()
+        if not cached:
+            return
+        self.devices = cached
+        self.update_device_menu()
+        self.selected_device_var.set(f"{cached[0][0]} ({cached[0][1]})")
+        scan_ms = device_cache.last_scan_ms()
+        saved = f", skipped a {scan_ms:.0f} ms scan" if scan_ms else ""
+        self.log(f"Loaded {len(cached)} cached device(s){saved}.")
+
     def scan_devices(self):
-        def async_scan():
-            self.selected_device_var.set("Scanning...")
-            self.devices = []
+        from SharedFiles import runtime
+        from SharedFiles.bluetooth import scan_devices
 
-            try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                found = loop.run_until_complete(scan_devices(timeout=5.0))
+        self.scanned = True
+        self.selected_device_var.set("Scanning...")
+        self.devices = []
 
+        def on_scanned(future):
+            try:
+                found = future.result()
                 self.devices = found if found else [("No devices found", "")]
             except Exception as e:
                 self.devices = [("Scan failed", "")]
                 self.log("Scan error:" + str(e))
 
-            self.update_device_menu()
+            self.root.after(0, self.update_device_menu)
 
-        threading.Thread(target=async_scan, daemon=True).start()
+        runtime.submit(scan_devices(timeout=5.0), timeout=15.0).add_done_callback(on_scanned)
 
     def update_device_menu(self):
         menu = self.device_menu["menu"]
@@ -196,59 +338,36 @@ class App:
 
     def on_confirm(self):
         self.finalize_current_point()
-        if not self.captured_points:
+        if not len(self.captured):
             self.log("No points captured.")
             return
 
         if not self.connected or not self.ble_handler:
             self.log("Not connected to BLE.")
             return
+        if self.intensities is None:
+            self.log("Enter the channel intensities in the terminal window first.")
+            return
 
-        points = self.captured_points[:]
-        self.captured_points.clear()
-
-        for point in points:
-            match point[0]:
-                case "P1" | "P2" | "P3":
-                    channel = "C0"
-                case "P5" | "P6" | "P7":
-                    channel = "C1"
-                case "P4":
-                    duration = int(round(point[1] * 1000, 0))
-
-                    message0 = "C0" + "I" + str(self.channel1_intensity) + "T" + str(duration) + "G"
-                    message1 = "C1" + "I" + str(self.channel2_intensity) + "T" + str(duration) + "G"
-
-                    self.send(message0)
-                    self.send(message1)
-
-                    sleep_time = (duration / 1000) - 0.5 if duration > 500 else 0
-                    sleep(sleep_time)
-
-                    continue
-
-                case _:
-                    self.log(f"Error for {point[0]}")
-                    self.log("No appropriate points to send!")
-                    return
-
-            duration = int(round(point[1] * 1000, 0))
-
-            message = channel + "I" + str(self.channel1_intensity) + "T" + str(duration) + "G" if channel == "C0" else channel + "I" + str(self.channel2_intensity) + "T" + str(duration) + "G"
-
-            self.send(message)
-
-            sleep_time = (duration / 1000) - 0.5 if duration > 500 else 0
-            sleep(sleep_time)
-
-            # "Fade Out" point for 500ms
-            message = channel + "I" + str(self.channel1_intensity) + "T500" + "G" if channel == "C0" else channel + "I" + str(self.channel2_intensity) + "T500" + "G"
-            self.send(message)
+        gesture = self.captured.compacted(self.FLICKER_MS)
+        self.log(f"{len(self.captured)} captured segments compressed to {len(gesture)}.")
+        points = gesture.points()
+        self.captured.clear()
 
-        self.captured_points = []
+        try:
+            events = gesture_events(points, self.intensities, self.layout.channels)
+        except ValueError as e:
+            self.log(str(e))
+            self.log("No appropriate points to send!")
+            return
 
-    def send(self, message):
-        print("Sending: " + message)
-        asyncio.run_coroutine_threadsafe(self.ble_handler.send(message), self.bg_loop)
+        # Played on the runtime, gestures confirmed meanwhile are queued behind it
+        self.gesture_count += 1
+        self.player.play(events, label=f"Gesture {self.gesture_count}")
 
+    def on_stop(self):
+        if not self.player:
+            self.log("Not connected to BLE.")
+            return
+        self.player.stop()
 
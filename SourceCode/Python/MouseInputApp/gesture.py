@@ -0,0 +1,80 @@
+import time
+from array import array
+
+
+class MotionThrottle:
+    """Lets at most one motion event through every interval_ms."""
+
+    def __init__(self, interval_ms=15):
+        self.interval = interval_ms / 1000
+        self.last = 0.0
+
+    def accept(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self.last < self.interval:
+            return False
+        self.last = now
+        return True
+
+    def reset(self):
+        self.last = 0.0
+
+
+class Gesture:
+    """A captured gesture as run-length encoded (target, duration) segments.
+
+    Targets are stored as indices into labels and durations in milliseconds,
+    both in flat arrays. Consecutive segments on the same target are merged as
+    they are added.
+    """
+
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self._index = {label: i for i, label in enumerate(self.labels)}
+        self.targets = array("H")
+        self.durations = array("I")
+
+    def __len__(self):
+        return len(self.targets)
+
+    def add(self, label, duration_ms):
+        target = self._index[label]
+        duration_ms = max(0, int(round(duration_ms)))
+        if self.targets and self.targets[-1] == target:
+            self.durations[-1] += duration_ms
+        else:
+            self.targets.append(target)
+            self.durations.append(duration_ms)
+
+    def clear(self):
+        del self.targets[:]
+        del self.durations[:]
+
+    def compacted(self, min_ms=80):
+        """A copy without segments shorter than min_ms.
+
+        The time of a dropped segment is added to the segment before it (or after
+        it, for the first one), and the neighbours are merged if they now share
+        a target. This removes the flicker of a pointer resting on a zone border.
+        """
+        result = Gesture(self.labels)
+        carry = 0
+        for target, duration in zip(self.targets, self.durations):
+            if duration < min_ms:
+                if result.targets:
+                    result.durations[-1] += duration
+                else:
+                    carry += duration
+                continue
+            result.add(self.labels[target], duration + carry)
+            carry = 0
+        if carry and not result.targets and self.targets:
+            # Everything was flicker, keep the longest segment with the whole duration
+            longest = max(range(len(self.targets)), key=self.durations.__getitem__)
+            result.add(self.labels[self.targets[longest]], carry)
+        return result
+
+    def points(self):
+        """(label, seconds) tuples with the 0.1 s rounding and minimum of the original capture."""
+        return [(self.labels[target], max(0.1, round(duration / 1000, 1)))
+                for target, duration in zip(self.targets, self.durations)]
@@ -1,12 +1,23 @@
+from SharedFiles import startup
 import tkinter as tk
-from app import App
-from SharedFiles.mqtt import MQTTReceiver
-from SharedFiles.bluetooth import BluetoothHandler
-import asyncio
-from bleak import BleakScanner
+from MouseInputApp.app import App
+
+startup.mark("imports")
 
 
 if __name__ == "__main__":
     root = tk.Tk()
+    startup.mark("tk")
     app = App(root)
+    startup.mark("app")
+
+    def ready():
+        # Runs once the window has been drawn and the loop waits for input
+        startup.mark("first frame")
+        startup.report("UI ready")
+
+    root.after_idle(ready)
     root.mainloop()
+
+    from SharedFiles import runtime
+    runtime.shutdown()
@@ -0,0 +1,134 @@
+import time
+from collections import deque
+
+
+class CanvasRenderer:
+    """Draws targets, the active zone and the pointer trail at a fixed frame rate.
+
+    Event handlers only change state (set_active, add_point, clear_trail);
+    a tick scheduled with after() every 1/fps seconds applies all changes since
+    the last frame at once. Every canvas item is created up front, frames only
+    move, recolor and hide them, so the cost of a frame does not grow with the
+    length of a gesture. A counter in the corner shows the mean time spent
+    drawing a frame and the frames per second actually reached.
+    """
+
+    TARGET_RADIUS = 5
+    ACTIVE_RADIUS = 9
+    TARGET_COLOR = "gray"
+    ACTIVE_COLOR = "red"
+    # Trail segments fade from the newest to the oldest
+    TRAIL_COLORS = ("#1f5fbf", "#4d7fcc", "#7a9fd9", "#a8bfe6", "#d5dff2")
+    # How often the frame time counter is updated
+    STATS_INTERVAL = 0.5
+
+    def __init__(self, canvas, fps=60, trail_length=48):
+        self.canvas = canvas
+        self.interval_ms = max(1, round(1000 / fps))
+        self.trail = deque(maxlen=trail_length)
+        self.active = None
+        self.targets = {}
+        self._positions = {}
+        self._dirty = True
+        self._job = None
+        self._drawn_active = None
+        self._drawn_segments = 0
+
+        # Fixed item pool: one segment per pair of trail points, the active zone ring and the counter
+        self._segments = [canvas.create_line(0, 0, 0, 0, width=3, capstyle="round", state="hidden", tags="trail")
+                          for _ in range(trail_length - 1)]
+        self._ring = canvas.create_oval(0, 0, 0, 0, outline=self.ACTIVE_COLOR, width=2, state="hidden")
+        self._counter = canvas.create_text(4, 4, anchor="nw", fill="gray40", font=("TkFixedFont", 8))
+
+        self._ticks = 0
+        self._frames = 0
+        self._draw_s = 0.0
+        self._stats_since = time.perf_counter()
+
+    def set_targets(self, points):
+        """Recreates the target items, only needed when the layout changes."""
+        self.canvas.delete("target")
+        self.targets = {
+            label: self.canvas.create_oval(x - self.TARGET_RADIUS, y - self.TARGET_RADIUS, x + self.TARGET_RADIUS,
+                                           y + self.TARGET_RADIUS, fill=self.TARGET_COLOR, tags="target")
+            for label, (x, y) in points.items()
+        }
+        self._positions = dict(points)
+        self._drawn_active = None
+        self.canvas.tag_raise("trail")
+        self.canvas.tag_raise(self._ring)
+        self._dirty = True
+
+    def set_active(self, label):
+        if label != self.active:
+            self.active = label
+            self._dirty = True
+
+    def add_point(self, x, y):
+        self.trail.append((x, y))
+        self._dirty = True
+
+    def clear_trail(self):
+        self.trail.clear()
+        self._dirty = True
+
+    def start(self):
+        if self._job is None:
+            self._job = self.canvas.after(self.interval_ms, self._tick)
+
+    def stop(self):
+        if self._job is not None:
+            self.canvas.after_cancel(self._job)
+            self._job = None
+
+    def _tick(self):
+        started = time.perf_counter()
+        self._ticks += 1
+        if self._dirty:
+            self._dirty = False
+            self._draw()
+            self._frames += 1
+            self._draw_s += time.perf_counter() - started
+        if started - self._stats_since >= self.STATS_INTERVAL:
+            self._update_counter(started)
+        # The next frame is due one interval after this one started
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._job = self.canvas.after(max(1, round(self.interval_ms - elapsed_ms)), self._tick)
+
+    def _draw(self):
+        canvas = self.canvas
+        if self.active != self._drawn_active:
+            if self._drawn_active in self.targets:
+                canvas.itemconfigure(self.targets[self._drawn_active], fill=self.TARGET_COLOR)
+            if self.active in self.targets:
+                x, y = self._positions[self.active]
+                r = self.ACTIVE_RADIUS
+                canvas.itemconfigure(self.targets[self.active], fill=self.ACTIVE_COLOR)
+                canvas.coords(self._ring, x - r, y - r, x + r, y + r)
+                canvas.itemconfigure(self._ring, state="normal")
+            else:
+                canvas.itemconfigure(self._ring, state="hidden")
+            self._drawn_active = self.active
+
+        points = list(self.trail)
+        shown = len(points) - 1
+        band = max(1, -(-len(self._segments) // len(self.TRAIL_COLORS)))
+        for i in range(max(0, shown)):
+            (x0, y0), (x1, y1) = points[i], points[i + 1]
+            canvas.coords(self._segments[i], x0, y0, x1, y1)
+            canvas.itemconfigure(self._segments[i], state="normal",
+                                 fill=self.TRAIL_COLORS[min(len(self.TRAIL_COLORS) - 1, (shown - 1 - i) // band)])
+        # Segments that were shown last frame but are not needed any more
+        for item in self._segments[max(0, shown):self._drawn_segments]:
+            canvas.itemconfigure(item, state="hidden")
+        self._drawn_segments = max(0, shown)
+
+    def _update_counter(self, now):
+        seconds = now - self._stats_since
+        frame_ms = self._draw_s / self._frames * 1000 if self._frames else 0.0
+        self.canvas.itemconfigure(
+            self._counter, text=f"{frame_ms:.2f} ms/frame  {self._frames / seconds:.0f} drawn/s  {self._ticks / seconds:.0f} fps")
+        self._ticks = 0
+        self._frames = 0
+        self._draw_s = 0.0
+        self._stats_since = now
@@ -0,0 +1,113 @@
+import json
+import math
+import os
+
+from SharedFiles.log import get_logger
+
+# The seven points of the original prototype, used when another layout cannot be read
+DEFAULT_LAYOUT_PATH = os.path.join(os.path.dirname(__file__), "targets.json")
+LAYOUT_PATH = os.environ.get("EMS_TARGET_LAYOUT", DEFAULT_LAYOUT_PATH)
+
+log = get_logger("targets")
+
+
+class TargetLayout:
+    """Target points on the canvas and the channels each of them stimulates."""
+
+    def __init__(self, points, channels, width=400, height=300):
+        self.points = dict(points)
+        self.channels = dict(channels)
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_dict(cls, layout):
+        targets = layout["targets"]
+        return cls(
+            {label: tuple(target["pos"]) for label, target in targets.items()},
+            {label: list(target["channels"]) for label, target in targets.items()},
+            layout.get("width", 400),
+            layout.get("height", 300),
+        )
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def load(cls, path=None):
+        """The layout in path, by default EMS_TARGET_LAYOUT, or the default layout if it cannot be read."""
+        path = path or LAYOUT_PATH
+        try:
+            return cls.read(path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if os.path.abspath(path) == os.path.abspath(DEFAULT_LAYOUT_PATH):
+                raise
+            log.warning("Could not load target layout %s (%s), using the default layout.", path, e)
+            return cls.default()
+
+    @classmethod
+    def default(cls):
+        return cls.read(DEFAULT_LAYOUT_PATH)
+
+
+class NearestTargetIndex:
+    """Constant time nearest-target lookup on a raster over the canvas.
+
+    Each cell stores the target that is nearest to all four of its corners.
+    Voronoi regions are convex, so then the whole cell belongs to that target.
+    Cells on a region border store the few targets that can be nearest to any
+    point inside them. Points outside the raster fall back to a full scan.
+    """
+
+    def __init__(self, points, width, height, cell=8):
+        self.points = list(points.items())
+        self.cell = cell
+        self.columns = max(1, math.ceil(width / cell))
+        self.rows = max(1, math.ceil(height / cell))
+        self.cells = self._build()
+
+    def _scan(self, x, y, points=None):
+        closest_label = None
+        min_dist = float("inf")
+        for label, (px, py) in points or self.points:
+            dist = math.hypot(x - px, y - py)
+            if dist < min_dist:
+                min_dist = dist
+                closest_label = label
+        return closest_label
+
+    def _build(self):
+        corners = [[self._scan(column * self.cell, row * self.cell) for column in range(self.columns + 1)]
+                   for row in range(self.rows + 1)]
+        cells = []
+        for row in range(self.rows):
+            top, bottom = corners[row], corners[row + 1]
+            for column in range(self.columns):
+                label = top[column]
+                if label == top[column + 1] == bottom[column] == bottom[column + 1]:
+                    cells.append(label)
+                else:
+                    cells.append(self._candidates(column, row))
+        return cells
+
+    def _candidates(self, column, row):
+        # Any point of the cell is within radius of its center, so only targets at most
+        # 2 * radius further from the center than the nearest one can be nearest
+        cx = (column + 0.5) * self.cell
+        cy = (row + 0.5) * self.cell
+        radius = self.cell / math.sqrt(2)
+        dists = [(math.hypot(cx - px, cy - py), label, (px, py)) for label, (px, py) in self.points]
+        limit = min(d for d, _, _ in dists) + 2 * radius
+        return tuple((label, pos) for d, label, pos in dists if d <= limit)
+
+    def nearest(self, x, y):
+        column = int(x // self.cell)
+        row = int(y // self.cell)
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            cell = self.cells[row * self.columns + column]
+            if isinstance(cell, str):
+                return cell
+            return self._scan(x, y, cell)
+        return self._scan(x, y)
@@ -0,0 +1,72 @@
+from SharedFiles import startup
+import argparse
+import json
+import os
+
+from SessionReplay.replay import compare_sessions, replay, session_summary
+from SharedFiles import runtime
+from SharedFiles.bluetooth import BluetoothHandler
+from SharedFiles.recorder import SessionRecorder, read_session
+
+startup.mark("imports")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a session log recorded with EMS_SESSION_LOG.")
+    parser.add_argument("log", help="session log to replay")
+    parser.add_argument("--address", help="comma separated addresses, one per recorded device in order of "
+                                          "appearance (default: emulated devices)")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale, 2.0 plays twice as fast")
+    parser.add_argument("--fast", action="store_true", help="send everything as fast as possible")
+    parser.add_argument("--record", help="record the replay to this log and compare its timing")
+    parser.add_argument("--summary", action="store_true", help="only print a summary of the log")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    records = read_session(args.log)
+    startup.mark("read log")
+    print(json.dumps(session_summary(records), indent=2))
+    if args.summary or not records:
+        return
+
+    if args.record and os.path.exists(args.record):
+        print(f"{args.record} exists already, choose a new file for the replay.")
+        return
+
+    speed = 0 if args.fast else args.speed
+    devices = list(dict.fromkeys(device for _, device, _ in records))
+    addresses = [a.strip() for a in args.address.split(",")] if args.address else []
+    addresses += [f"EMU:replay{i}" for i in range(len(addresses), len(devices))]
+    recorder = SessionRecorder(args.record) if args.record else None
+
+    handlers = {}
+    for device, address in zip(devices, addresses):
+        # The recorded writes are sent one by one as they are, nothing is merged or elided. There is no
+        # ConnectionSupervisor, its keepalives would be writes that are not in the recording.
+        handler = BluetoothHandler(address, coalesce_window=0, elide_redundant=False, merge=False)
+        handler.recorder = recorder
+        handlers[device] = handler
+
+    try:
+        for handler in handlers.values():
+            runtime.run(handler.connect(timeout=10.0))
+        startup.mark("connect")
+        startup.report()
+        timelines = runtime.run(replay(records, handlers, speed))
+        print("Max scheduling error: " + str(round(max(t.max_jitter_ms() for t in timelines), 2)) + " ms")
+        if recorder:
+            recorder.flush()
+            print("Timing error against the recording: "
+                  + json.dumps(compare_sessions(records, read_session(args.record), speed)))
+    finally:
+        for handler in handlers.values():
+            runtime.run(handler.disconnect(), timeout=5.0)
+        if recorder:
+            recorder.close()
+        runtime.shutdown()
+
+
+if __name__ == "__main__":
+    main()
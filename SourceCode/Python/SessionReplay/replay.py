@@ -0,0 +1,85 @@
+import asyncio
+
+from SharedFiles.framing import StateUpdate, decode_frame, is_frame
+from SharedFiles.supervisor import KEEPALIVE_COMMAND
+from SharedFiles.timeline import Timeline
+
+
+def session_events(records, speed=1.0):
+    """{device: [(offset_ms, payload)]} relative to the first write of the session.
+
+    speed scales time (2.0 plays twice as fast), 0 sends everything as fast as possible.
+    """
+    events = {}
+    if not records:
+        return events
+    start = records[0][0]
+    for timestamp_ns, device, payload in records:
+        offset_ms = (timestamp_ns - start) / 1e6 / speed if speed > 0 else 0
+        events.setdefault(device, []).append((offset_ms, payload))
+    return events
+
+
+async def replay(records, handlers, speed=1.0):
+    """Re-drives the writes of each recorded device on handlers[device], all devices at once."""
+    timelines = []
+    for device, events in session_events(records, speed).items():
+        handler = handlers[device]
+
+        async def send(payload, handler=handler):
+            # Frames are replayed as ASCII commands on devices that do not support them
+            if is_frame(payload) and not handler.frames_supported:
+                payload = StateUpdate(decode_frame(payload))
+            await handler.send(payload)
+
+        timelines.append(Timeline(events, send))
+    await asyncio.gather(*(timeline.run() for timeline in timelines))
+    return timelines
+
+
+def _stats(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+        "max": values[-1],
+    }
+
+
+def session_summary(records):
+    """Writes per device, duration and the spacing of consecutive writes in ms."""
+    devices = {}
+    for _, device, _ in records:
+        devices[device] = devices.get(device, 0) + 1
+    intervals = [(b[0] - a[0]) / 1e6 for a, b in zip(records, records[1:])]
+    return {
+        "writes": len(records),
+        "devices": devices,
+        "duration_s": (records[-1][0] - records[0][0]) / 1e9 if records else 0.0,
+        "interval_ms": _stats(intervals),
+    }
+
+
+def _without_keepalives(records):
+    keepalive = KEEPALIVE_COMMAND.encode()
+    return [record for record in records if record[2] != keepalive]
+
+
+def compare_sessions(original, replayed, speed=1.0):
+    """Timing error in ms of every replayed write against its scaled original offset, matched by position.
+
+    Keepalives are left out on both sides, they are written whenever a link
+    has been idle and do not line up with the stimulation around them.
+    """
+    original, replayed = _without_keepalives(original), _without_keepalives(replayed)
+    if not original or not replayed or speed <= 0:
+        return _stats([])
+    errors = [
+        abs((r[0] - replayed[0][0]) - (o[0] - original[0][0]) / speed) / 1e6
+        for o, r in zip(original, replayed)
+    ]
+    return _stats(errors)
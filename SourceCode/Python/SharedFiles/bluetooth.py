@@ -1,37 +1,117 @@
+import asyncio
+import time
+
+from SharedFiles import commands, device_cache, emulator, runtime
+from SharedFiles.framing import (FEATURE_BINARY_FRAMES, FEATURE_PACKED_COMMANDS, StateUpdate, decode_frame,
+                                 is_frame, read_features)
+from SharedFiles.lanes import BEST_EFFORT, STATE, STOP, PriorityLanes
+from SharedFiles.log import DEBUG, get_logger
+from SharedFiles.metrics import channel_key, default_tracer
+from SharedFiles.mirror import DeviceMirror
+from SharedFiles.recorder import default_recorder
+
+# The toolkit's RN4020 exposes 20 byte private characteristics
+MAX_WRITE_SIZE = 20
+
+log = get_logger("bluetooth")
 
-from bleak import BleakScanner, BleakClient
 
 async def scan_devices(timeout=5.0):
     """Scan for nearby BLE devices."""
-    print("Scanning for BLE devices...")
+    if emulator.enabled():
+        return emulator.scan()
+
+    from bleak import BleakScanner
+
+    log.info("Scanning for BLE devices...")
+    start = time.perf_counter()
     devices = await BleakScanner.discover(timeout=timeout)
-    return [(d.name or "Unknown", d.address) for d in devices]
+    found = [(d.name or "Unknown", d.address) for d in devices]
+    device_cache.remember_scan(found, (time.perf_counter() - start) * 1000)
+    return found
 
 
 class BluetoothHandler:
-    def __init__(self, address: str):
+    def __init__(self, address: str, coalesce_window=0, response=True, max_pending=64,
+                 max_write_size=MAX_WRITE_SIZE, client=None, use_cache=True, binary_frames=True,
+                 channel_count=commands.CHANNEL_COUNT, elide_redundant=True, recorder=None, tracer=None,
+                 merge=True):
         self.address = address
-        self.client = BleakClient(address)
+        # Binary frames are used for StateUpdates when allowed here and supported by the device
+        self.binary_frames = binary_frames
+        self.frames_supported = False
+        # Several ASCII commands per write, only for devices that advertise applying all of them
+        self.packing_supported = False
+        self.channel_count = channel_count
+        # Commands that would not change the device state are not written
+        self.mirror = DeviceMirror(channel_count) if elide_redundant else None
+        # Every GATT write is appended to this SessionRecorder, by default the one of EMS_SESSION_LOG
+        self.recorder = recorder if recorder is not None else default_recorder()
+        # Per-command latencies go to this metrics.Tracer, by default the one of EMS_METRICS
+        self.tracer = tracer if tracer is not None else default_tracer()
+        self.use_cache = use_cache
+        self.connect_ms = None
+        # Called with the handler when the link drops
+        self.disconnect_callbacks = []
+        if client is None:
+            if emulator.is_emulated(address):
+                client = emulator.EmulatedClient(address, disconnected_callback=self._on_client_disconnect)
+            else:
+                from bleak import BleakClient
+                client = BleakClient(address, disconnected_callback=self._on_client_disconnect)
+        elif getattr(client, "disconnected_callback", False) is None:
+            client.disconnected_callback = self._on_client_disconnect
+        self.client = client
         self.characteristic_uuid = None
 
+        # Send pipeline: commands are queued per priority and written by a single writer task.
+        # Commands arriving within coalesce_window seconds are merged into one GATT write. It is 0 by
+        # default, so an isolated command is written right away; commands already queued are merged anyway.
+        # Without merge, or when the device does not advertise FEATURE_PACKED_COMMANDS, every
+        # command is written on its own, whatever is queued behind it.
+        self.coalesce_window = coalesce_window
+        self.merge = merge
+        self.response = response
+        self.max_pending = max_pending
+        # Bounds sends handed over from other threads with submit(), send() only bounds the queue
+        self.throttle = runtime.Throttle(max_pending)
+        self.max_write_size = max_write_size
+        # Queued commands dropped because a stop for their channels overtook them
+        self.superseded = 0
+        self._lanes = None
+        self._writer_task = None
+        self._writer_loop = None
+
     async def connect(self, timeout=10.0):
-        print(f"Connecting to {self.address} with timeout {timeout}s...")
+        log.info("Connecting to %s with timeout %ss...", self.address, timeout)
+        start = time.perf_counter()
+        self._forget_state()
         try:
             await self.client.connect(timeout=timeout)
             if not self.client.is_connected:
                 raise ConnectionError("Failed to connect to BLE device.")
 
-            print("Connected. Discovering services...")
+            # The characteristic is a fixed UUID, a cached one only skips the loop over the services below
+            cached = device_cache.cached_characteristic(self.address) if self._caching() else None
+            if cached:
+                self.characteristic_uuid = cached
+                await self._negotiate()
+                self._connected(start, "cached characteristic")
+                return
+
+            log.info("Connected. Discovering services...")
             # This populates self.client.services
             # await self.client.get_services()
 
             for service in self.client.services:
-                print("Service found: " + service.uuid)
+                log.info("Service found: %s", service.uuid)
                 if service.characteristics is not None:
                     # self.characteristic_uuid = service.characteristics[0].uuid
                     self.characteristic_uuid = "454d532d537465756572756e672d4348"
-                    print("Characteristic found: " + self.characteristic_uuid)
+                    log.info("Characteristic found: %s", self.characteristic_uuid)
                     # print(service.characteristics[0].properties)
+                    await self._negotiate()
+                    self._connected(start, "service discovery")
                     return
                 # for char in service.characteristics:
                 #     self.characteristic_uuid = char.uuid
@@ -45,15 +125,228 @@ class BluetoothHandler:
         except Exception as e:
             raise e
 
-    async def send(self, data: str):
+    async def _negotiate(self):
+        features = await read_features(self.client)
+        self.frames_supported = self.binary_frames and bool(features & FEATURE_BINARY_FRAMES)
+        self.packing_supported = bool(features & FEATURE_PACKED_COMMANDS)
+        log.info("Using %s for state updates%s.", "binary frames" if self.frames_supported else "ASCII commands",
+                 "" if self.packing_supported else ", one command per write")
+
+    def _forget_state(self):
+        if self.mirror is not None:
+            self.mirror.reset()
+
+    def _on_client_disconnect(self, client):
+        self._forget_state()
+        for callback in list(self.disconnect_callbacks):
+            callback(self)
+
+    def _connected(self, start, source):
+        self.connect_ms = (time.perf_counter() - start) * 1000
+        log.info("Connected in %.0f ms (%s).", self.connect_ms, source)
+        if self._caching():
+            device_cache.remember_connection(self.address, self.characteristic_uuid, self.connect_ms)
+
+    def _caching(self):
+        # Emulated devices would only fill the cache of real toolkits
+        return self.use_cache and not emulator.is_emulated(self.address)
+
+    def _payloads(self, data, force):
+        if isinstance(data, StateUpdate):
+            if self.mirror is not None:
+                changed = self.mirror.filter(data.channels, force)
+                if not changed:
+                    return []
+                if len(changed) < len(data.channels):
+                    data = StateUpdate(changed)
+            if self.frames_supported:
+                frame = data.frame(self.channel_count)
+                # Frames carry every channel, more than 6 do not fit in 20 bytes
+                if len(frame) <= self.max_write_size:
+                    return [frame]
+            return self._pack(data.payloads(self.channel_count))
+
+        payload = data.encode() if isinstance(data, str) else bytes(data)
+        packing = self._packing()
+        parsed = commands.decode(payload, self.channel_count) if self.mirror is not None or not packing else None
+        if parsed:
+            kept = [part for part in parsed
+                    if self.mirror is None or self.mirror.filter({part[0]: part[1:]}, force)]
+            if len(kept) < len(parsed) or (len(kept) > 1 and not packing):
+                return self._pack([commands.command(*part, self.channel_count) for part in kept])
+        return [payload]
+
+    def _packing(self):
+        return self.merge and self.packing_supported
+
+    def _pack(self, payloads):
+        """Commands of one update joined into as few writes of max_write_size as possible.
+
+        Every command is a write of its own without merge or when the device
+        may only apply the first command of a write.
+        """
+        if not self._packing():
+            return list(payloads)
+        packed = []
+        for payload in payloads:
+            if packed and len(packed[-1]) + len(payload) <= self.max_write_size:
+                packed[-1] += payload
+            else:
+                packed.append(payload)
+        return packed
+
+    def _channels(self, payload):
+        """{channel: (intensity, duration)} set by payload, None if it is not a channel command."""
+        if is_frame(payload):
+            return decode_frame(payload)
+        parsed = commands.decode(payload, self.channel_count)
+        return {channel: (intensity, duration) for channel, intensity, duration in parsed} if parsed else None
+
+    def _priority(self, payloads, force):
+        updates = [self._channels(payload) for payload in payloads]
+        if not updates or None in updates:
+            return BEST_EFFORT
+        # Forced offs are stops
+        if force and all(duration == 0 for update in updates for _, duration in update.values()):
+            return STOP
+        return STATE
+
+    def _supersede(self, payloads):
+        """Drop queued commands that only touch channels the stop in payloads turns off."""
+        stopped = set()
+        for payload in payloads:
+            stopped.update(self._channels(payload))
+
+        def superseded(item):
+            channels = self._channels(item[0])
+            return bool(channels) and stopped.issuperset(channels)
+
+        removed = self._lanes.remove(superseded, (STATE, BEST_EFFORT))
+        for _, done, _ in removed:
+            if not done.done():
+                done.set_result(None)
+        self._lanes.task_done(len(removed))
+        self.superseded += len(removed)
+
+    async def send(self, data, force=False, priority=None):
+        """Queue a command and wait until it has been written to the device.
+
+        data is an ASCII command (str or bytes) or a StateUpdate. Commands the
+        mirror considers redundant return right away unless force is set.
+        Without a priority, forced offs are sent as STOP, channel commands as
+        STATE and everything else as BEST_EFFORT. A STOP is written before
+        anything else that is queued and drops queued commands for its channels.
+        Waits for queue space first, so a fast producer is slowed down instead
+        of growing the queue without bound.
+        """
         if not self.client.is_connected:
             raise ConnectionError("BLE device not connected.")
         if not self.characteristic_uuid:
             raise ValueError("No writable characteristic selected.")
-        await self.client.write_gatt_char(self.characteristic_uuid, data.encode())
-        print(f"Sent: {data}")
+
+        force = force or (isinstance(data, StateUpdate) and data.force)
+        payloads = self._payloads(data, force)
+        for payload in payloads:
+            if len(payload) > self.max_write_size:
+                raise ValueError(f"Command exceeds {self.max_write_size} bytes: {payload!r}")
+
+        if priority is None:
+            priority = self._priority(payloads, force)
+        self._ensure_writer()
+        if priority == STOP and payloads:
+            self._supersede(payloads)
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter_ns() if self.tracer is not None else 0
+        pending = []
+        for payload in payloads:
+            done = loop.create_future()
+            await self._lanes.put((payload, done, submitted), priority)
+            pending.append(done)
+        try:
+            await asyncio.gather(*pending)
+        except Exception:
+            # The write may or may not have reached the device
+            self._forget_state()
+            raise
+
+    def submit(self, data, force=False):
+        """send() from any thread, returns a concurrent future.
+
+        Waits while max_pending submitted sends are unfinished, so a caller
+        that does not wait for the futures cannot pile them up on the runtime.
+        """
+        return self.throttle.submit(self.send(data, force))
+
+    async def flush(self):
+        """Wait until every queued command has been written."""
+        if self._lanes is not None and self._writer_loop is asyncio.get_running_loop():
+            await self._lanes.join()
+
+    def _ensure_writer(self):
+        loop = asyncio.get_running_loop()
+        if self._writer_loop is loop and self._writer_task and not self._writer_task.done():
+            return
+        self._lanes = PriorityLanes(self.max_pending)
+        self._writer_loop = loop
+        self._writer_task = loop.create_task(self._writer())
+
+    async def _writer(self):
+        lanes = self._lanes
+        while True:
+            priority, item = await lanes.get()
+            batch = [item]
+            dequeued = [time.perf_counter_ns()] if self.tracer is not None else None
+
+            # Binary frames are always written on their own, so they never wait, and neither do stops
+            alone = is_frame(item[0]) or not self._packing()
+            # Only wait for more commands when there is no backlog to merge already
+            if self.coalesce_window > 0 and lanes.empty() and not alone and priority != STOP:
+                await lanes.wait_unless_stopped(self.coalesce_window)
+
+            # Merges the most urgent queued commands, so a stop that arrived meanwhile is included
+            size = len(item[0])
+            while not alone:
+                item = lanes.peek()
+                if item is None or is_frame(item[0]) or size + len(item[0]) > self.max_write_size:
+                    break
+                batch.append(lanes.get_nowait()[1])
+                size += len(item[0])
+                if dequeued is not None:
+                    dequeued.append(time.perf_counter_ns())
+
+            payload = b"".join(p for p, _, _ in batch)
+            try:
+                write_start = time.perf_counter_ns() if dequeued is not None else 0
+                await self.client.write_gatt_char(self.characteristic_uuid, payload, response=self.response)
+                if dequeued is not None:
+                    self._trace(batch, dequeued, write_start, time.perf_counter_ns())
+                if self.recorder is not None:
+                    self.recorder.record(self.address, payload)
+                if log.isEnabledFor(DEBUG):
+                    log.debug("Sent: %s", payload.hex() if is_frame(payload) else payload.decode(errors="replace"))
+                for _, done, _ in batch:
+                    if not done.done():
+                        done.set_result(None)
+            except Exception as e:
+                for _, done, _ in batch:
+                    if not done.done():
+                        done.set_exception(e)
+            finally:
+                lanes.task_done(len(batch))
+
+    def _trace(self, batch, dequeued, write_start, write_end):
+        record = self.tracer.record
+        for (payload, _, submitted), taken in zip(batch, dequeued):
+            channel = channel_key(payload)
+            record(self.address, channel, "queue", taken - submitted)
+            record(self.address, channel, "wait", write_start - taken)
+            record(self.address, channel, "write", write_end - write_start)
+            record(self.address, channel, "total", write_end - submitted)
 
     async def disconnect(self):
+        if self._writer_task and self._writer_loop is asyncio.get_running_loop():
+            await self.flush()
+            self._writer_task.cancel()
+        self._writer_task = None
         await self.client.disconnect()
-        print("Disconnected from BLE device.")
-
+        log.info("Disconnected from BLE device.")
@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import re
+import threading
+import time
+from collections import deque
+
+from SharedFiles import commands, runtime
+from SharedFiles.log import get_logger
+
+_COMMAND = re.compile(r"[^G]*G")
+_CHANNEL = re.compile(r"C(\d+)")
+
+log = get_logger("bridge")
+
+
+class MQTTBridge:
+    """Forwards command payloads from MQTT to a BLE handler on the shared runtime.
+
+    Messages are handed over from paho's network thread into per-channel slots
+    where the latest command wins, so a burst of touch updates collapses to the
+    current state instead of queueing up. Commands without a channel go into a
+    bounded FIFO that drops its oldest entries. Both are forwarded in the order
+    they arrived in, a channel command at the position of its latest version.
+    The handler writes channel commands before other queued ones, so each run
+    of one kind is handed over only after the previous run has been written.
+    Channel commands outside the firmware limits and text without the closing
+    G, e.g. a trailing fragment, are rejected. The delay from MQTT arrival to
+    write completion is recorded for every forwarded command.
+    """
+
+    def __init__(self, handler, broker_address, topic, max_other=16, max_samples=1000, receiver=None):
+        self.handler = handler
+        if receiver is None:
+            from SharedFiles.mqtt import MQTTReceiver
+            receiver = MQTTReceiver(broker_address, topic, on_message_callback=self.on_message)
+        self.receiver = receiver
+        self.forwarded = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.latency_ms = deque(maxlen=max_samples)
+
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._other = deque(maxlen=max_other)
+        # Arrival order across the slots and the FIFO
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._wakeup_pending = False
+        self._task = None
+
+    def start(self):
+        runtime.run(self._start())
+        self.receiver.start()
+
+    def stop(self):
+        self.receiver.stop()
+        if self._task is not None:
+            runtime.call_soon(self._task.cancel)
+
+    async def _start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._forward())
+
+    def on_message(self, message):
+        """Called on the MQTT network thread."""
+        arrived = time.perf_counter()
+        message = message.strip()
+        received = _COMMAND.findall(message)
+        # Whatever follows the last G is not a complete command
+        unterminated = message[sum(len(command) for command in received):]
+        with self._lock:
+            if unterminated:
+                self.rejected += 1
+                log.warning("Rejected command without G: %r", unterminated)
+            for command in received:
+                if _CHANNEL.search(command):
+                    try:
+                        parsed = commands.parse(command)
+                    except ValueError as e:
+                        self.rejected += 1
+                        log.warning("Rejected command: %s", e)
+                        continue
+                    # Keyed by the channel number, so C01 and C1 supersede each other
+                    channel = parsed[0]
+                    if channel in self._slots:
+                        self.superseded += 1
+                    self._slots[channel] = (next(self._sequence), True, commands.command(*parsed), arrived)
+                else:
+                    if len(self._other) == self._other.maxlen:
+                        self.dropped += 1
+                    self._other.append((next(self._sequence), False, command, arrived))
+            # One wakeup per batch, not per message
+            wake = received and not self._wakeup_pending
+            if wake:
+                self._wakeup_pending = True
+        if wake:
+            runtime.call_soon(self._wakeup.set)
+
+    async def _forward(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                self._wakeup_pending = False
+                pending = sorted([*self._slots.values(), *self._other])
+                self._slots.clear()
+                self._other.clear()
+            for _, run in itertools.groupby(pending, key=lambda entry: entry[1]):
+                # A run is sent together so the handler can merge it into one write
+                await asyncio.gather(*(self._send(command, arrived) for _, _, command, arrived in run))
+
+    async def _send(self, command, arrived):
+        try:
+            await self.handler.send(command)
+        except Exception as e:
+            self.dropped += 1
+            log.warning("Failed to forward over BLE: %s", e)
+            return
+        self.forwarded += 1
+        self.latency_ms.append((time.perf_counter() - arrived) * 1000)
+
+    def stats(self):
+        latencies = sorted(self.latency_ms)
+        return {
+            "forwarded": self.forwarded,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "latency_p50_ms": latencies[len(latencies) // 2] if latencies else None,
+            "latency_max_ms": latencies[-1] if latencies else None,
+        }
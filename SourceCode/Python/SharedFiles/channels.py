@@ -0,0 +1,77 @@
+"""Calibrated intensities of every channel of a rig as NumPy vectors.
+
+ChannelArray works for any channel count up to the frame limit (the firmware
+takes the count in EMSSystem(channels); set EMS_CHANNEL_COUNT for rigs with
+more than two). update() sets many channels in one vectorized step and
+returns a single StateUpdate, which BluetoothHandler writes as one binary
+frame where the device supports them, otherwise as the fewest ASCII writes
+the commands of all channels fit into.
+"""
+import numpy as np
+
+from SharedFiles.commands import CHANNEL_COUNT, MAX_DURATION, MAX_INTENSITY
+from SharedFiles.framing import MAX_FRAME_CHANNELS, StateUpdate
+
+
+class ChannelArray:
+    def __init__(self, count=CHANNEL_COUNT, intensities=MAX_INTENSITY):
+        if not 0 < count <= MAX_FRAME_CHANNELS:
+            raise ValueError(f"Channel count {count} out of range 1..{MAX_FRAME_CHANNELS}.")
+        # Calibrated intensity per channel, what a level of 1.0 stands for
+        self.intensities = np.empty(count, dtype=np.int64)
+        self.intensities[:] = intensities
+        self._check(self.intensities, 1, MAX_INTENSITY, "Intensity")
+
+    @classmethod
+    def from_calibration(cls, calibration, count=CHANNEL_COUNT):
+        """From {channel: intensity}, e.g. participants.calibration(); missing channels get the maximum."""
+        array = cls(count)
+        for channel, intensity in (calibration or {}).items():
+            if channel < count:
+                array[channel] = intensity
+        return array
+
+    def __len__(self):
+        return len(self.intensities)
+
+    def __getitem__(self, channel):
+        return int(self.intensities[channel])
+
+    def __setitem__(self, channel, intensity):
+        self._check(np.atleast_1d(intensity), 1, MAX_INTENSITY, "Intensity")
+        self.intensities[channel] = intensity
+
+    def __repr__(self):
+        return f"ChannelArray({self.intensities.tolist()})"
+
+    def as_dict(self):
+        return dict(enumerate(self.intensities.tolist()))
+
+    def update(self, levels=1.0, durations=MAX_DURATION, channels=None, force=False):
+        """One StateUpdate running channels at levels (0..1 of their intensity) for durations ms.
+
+        levels and durations are scalars or one value per channel; channels
+        defaults to all of them. Channels that end up at intensity 0 are sent
+        as off, the firmware would run I0 at full strength.
+        """
+        channels = np.arange(len(self)) if channels is None else np.asarray(channels, dtype=np.int64)
+        levels = np.broadcast_to(np.asarray(levels, dtype=np.float64), channels.shape)
+        durations = np.broadcast_to(np.asarray(durations, dtype=np.int64), channels.shape)
+        self._check(channels, 0, len(self) - 1, "Channel")
+        self._check(levels, 0, 1, "Level")
+        self._check(durations, 0, MAX_DURATION, "Duration")
+
+        intensity = np.rint(levels * self.intensities[channels]).astype(np.int64)
+        off = (intensity == 0) | (durations == 0)
+        intensity = np.where(off, 0, intensity)
+        durations = np.where(off, 0, durations)
+        return StateUpdate(dict(zip(channels.tolist(), zip(intensity.tolist(), durations.tolist()))), force)
+
+    def off(self, channels=None, force=True):
+        return StateUpdate.off(range(len(self)) if channels is None else channels, force)
+
+    @staticmethod
+    def _check(values, low, high, name):
+        outside = (values < low) | (values > high)
+        if outside.any():
+            raise ValueError(f"{name} {values[outside][0]} out of range {low}..{high}.")
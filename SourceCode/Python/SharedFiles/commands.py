@@ -0,0 +1,73 @@
+"""Typed EMS commands, checked against the firmware limits and encoded once.
+
+command(channel, intensity, duration) returns the ASCII bytes of
+C<channel>I<intensity>T<duration>G. Results are kept in a bounded cache, so
+sending the same command again does no formatting or encoding. Anything the
+firmware would misread raises ValueError before it is queued for the radio.
+"""
+import os
+import re
+from functools import lru_cache
+
+# Channels of the toolkit, EMSSystem(2) in the firmware; rigs with more set EMS_CHANNEL_COUNT
+CHANNEL_COUNT = int(os.environ.get("EMS_CHANNEL_COUNT") or 2)
+MAX_INTENSITY = 100
+# The firmware clamps longer signals to 30 s
+MAX_DURATION = 30000
+CACHE_SIZE = 1024
+
+_PATTERN = re.compile(r"C(\d+)I(\d+)T(\d+)G")
+
+
+def validate(channel, intensity, duration, channel_count=CHANNEL_COUNT):
+    for name, value in (("channel", channel), ("intensity", intensity), ("duration", duration)):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f"{name} must be an int, got {value!r}")
+    # An unknown channel makes the firmware shut down every channel
+    if not 0 <= channel < channel_count:
+        raise ValueError(f"Channel {channel} out of range 0..{channel_count - 1}.")
+    if not 0 <= intensity <= MAX_INTENSITY:
+        raise ValueError(f"Intensity {intensity} out of range 0..{MAX_INTENSITY}.")
+    if not 0 <= duration <= MAX_DURATION:
+        raise ValueError(f"Duration {duration} out of range 0..{MAX_DURATION} ms.")
+    # The firmware stores intensity - 1 in a uint8, so I0 would run at full strength
+    if intensity == 0 and duration > 0:
+        raise ValueError("Intensity 0 is only valid with duration 0 (channel off).")
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def command(channel: int, intensity: int, duration: int, channel_count: int = CHANNEL_COUNT) -> bytes:
+    validate(channel, intensity, duration, channel_count)
+    return b"C%dI%dT%dG" % (channel, intensity, duration)
+
+
+def off(channel: int, channel_count: int = CHANNEL_COUNT) -> bytes:
+    return command(channel, 0, 0, channel_count)
+
+
+def parse(text, channel_count=CHANNEL_COUNT):
+    """(channel, intensity, duration) of one ASCII command, ValueError if it is not valid."""
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode("latin-1")
+    match = _PATTERN.fullmatch(text)
+    if not match:
+        raise ValueError(f"Not a command: {text!r}")
+    channel, intensity, duration = (int(group) for group in match.groups())
+    validate(channel, intensity, duration, channel_count)
+    return channel, intensity, duration
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def decode(payload: bytes, channel_count: int = CHANNEL_COUNT):
+    """(channel, intensity, duration) of every command in an encoded payload, None if any part is not valid."""
+    parts = payload.split(b"G")
+    if len(parts) < 2 or parts[-1]:
+        return None
+    try:
+        return tuple(parse(part + b"G", channel_count) for part in parts[:-1])
+    except ValueError:
+        return None
+
+
+def cache_info():
+    return command.cache_info()
@@ -0,0 +1,100 @@
+"""Small JSON cache of known toolkits, so a session can start without a scan.
+
+For every address it keeps the advertised name, when it was last seen, the
+characteristic used on the last connect and how long connecting took. What
+saves time is skipping the scan; the characteristic is the toolkit's fixed
+UUID, so reusing it only skips a loop over the services bleak has already
+discovered while connecting. Emulated devices are not cached. The file lives
+in ~/.ems_simulation/devices.json unless EMS_DEVICE_CACHE points somewhere
+else.
+"""
+import json
+import os
+import time
+
+from SharedFiles.log import get_logger
+
+CACHE_PATH = os.environ.get(
+    "EMS_DEVICE_CACHE", os.path.join(os.path.expanduser("~"), ".ems_simulation", "devices.json"))
+VERSION = 1
+# Entries older than this are ignored, the toolkit may have been re-flashed since
+MAX_AGE = 30 * 24 * 3600
+
+log = get_logger("device_cache")
+
+
+def load(path=None):
+    path = path or CACHE_PATH
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache.get("version") == VERSION:
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {"version": VERSION, "devices": {}}
+
+
+def save(cache, path=None):
+    path = path or CACHE_PATH
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning("Could not write device cache: %s", e)
+
+
+def _fresh(entry, now):
+    return now - entry.get("last_seen", 0) <= MAX_AGE
+
+
+def remember_scan(devices, scan_ms, path=None):
+    """Store the (name, address) pairs of a scan and how long the scan took."""
+    cache = load(path)
+    now = time.time()
+    for name, address in devices:
+        if address:
+            entry = cache["devices"].setdefault(address, {})
+            entry["name"] = name
+            entry["last_seen"] = now
+    cache["last_scan_ms"] = scan_ms
+    save(cache, path)
+
+
+def remember_connection(address, characteristic_uuid, connect_ms, path=None):
+    cache = load(path)
+    now = time.time()
+    entry = cache["devices"].setdefault(address, {"name": "Unknown"})
+    entry["last_seen"] = now
+    entry["last_connected"] = now
+    entry["characteristic"] = characteristic_uuid
+    entry["connect_ms"] = connect_ms
+    save(cache, path)
+
+
+def forget(address, path=None):
+    cache = load(path)
+    if cache["devices"].pop(address, None) is not None:
+        save(cache, path)
+
+
+def cached_devices(path=None):
+    """(name, address) pairs of fresh entries, most recently connected first."""
+    now = time.time()
+    entries = [(address, entry) for address, entry in load(path)["devices"].items() if _fresh(entry, now)]
+    entries.sort(key=lambda item: (item[1].get("last_connected", 0), item[1].get("last_seen", 0)), reverse=True)
+    return [(entry.get("name", "Unknown"), address) for address, entry in entries]
+
+
+def cached_characteristic(address, path=None):
+    entry = load(path)["devices"].get(address)
+    if entry and _fresh(entry, time.time()):
+        return entry.get("characteristic")
+    return None
+
+
+def last_scan_ms(path=None):
+    return load(path).get("last_scan_ms")
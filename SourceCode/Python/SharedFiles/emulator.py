@@ -0,0 +1,348 @@
+"""In-process stand-in for the EMS toolkit.
+
+EmulatedClient has the subset of the BleakClient interface used by
+BluetoothHandler, and EMSDevice reproduces how the firmware (EMSSystem /
+EMSChannel) reacts to the commands it receives. Addresses starting with
+EMULATOR_PREFIX are routed to the emulator by BluetoothHandler, and setting
+EMS_EMULATOR=1 makes scan_devices list emulated toolkits instead of scanning.
+"""
+import asyncio
+import os
+import random
+import time
+
+from SharedFiles import framing
+from SharedFiles.commands import CHANNEL_COUNT
+
+EMULATOR_PREFIX = "EMU"
+SERVICE_UUID = "454d532d536572766963652d424c4531"
+CHARACTERISTIC_UUID = "454d532d537465756572756e672d4348"
+
+ACTION = "G"
+CHANNEL = "C"
+INTENSITY = "I"
+TIME = "T"
+OPTION = "O"
+
+MAX_SIGNAL_LENGTH = 30000
+DEACTIVATING_TIME = 50
+POTI_STEPS_UP = 255
+
+OFF, ON, DEACTIVATING = "off", "on", "deactivating"
+
+
+def is_emulated(address):
+    return str(address).upper().startswith(EMULATOR_PREFIX)
+
+
+def enabled():
+    return os.environ.get("EMS_EMULATOR", "") not in ("", "0")
+
+
+def scan(count=None):
+    count = int(os.environ.get("EMS_EMULATOR_COUNT", "1")) if count is None else count
+    return [(f"ModiEMS Emulator {i}", f"{EMULATOR_PREFIX}:{i}") for i in range(count)]
+
+
+def _int16(value):
+    # int is 16 bit on the AVR, parsed numbers wrap around like on the device
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+def _uint8(value):
+    return int(value) & 0xFF
+
+
+def get_next_number_of_string(command, start_index):
+    """Mirror of EMSSystem::getNextNumberOfString."""
+    value = 0
+    valid = False
+    for char in command[start_index + 1:]:
+        if "0" <= char <= "9":
+            value = _int16(value * 10 + (ord(char) - ord("0")))
+            valid = True
+        else:
+            break
+    return value if valid else -1
+
+
+class EmulatedChannel:
+    """Mirror of EMSChannel, with millis() replaced by the device clock.
+
+    percent is the value passed to setIntensity, i.e. the commanded intensity
+    minus one, wrapped to uint8 like on the device.
+    """
+
+    def __init__(self, index, transitions):
+        self.index = index
+        self.transitions = transitions
+        self.state = OFF
+        self.intensity = 0
+        self.percent = 0
+        self.max_intensity = 215
+        self.min_intensity = 55
+        self.end_time = 0
+        self.deactivating_time = 0
+        self.on_time = 1
+
+    def _set_state(self, state, now):
+        if state != self.state or state == ON:
+            self.transitions.append((now, self.index, state, self.percent if state == ON else 0))
+        self.state = state
+
+    def set_intensity(self, intensity):
+        intensity = _uint8(intensity)
+        self.percent = intensity
+        self.intensity = _uint8(_uint8((self.max_intensity - self.min_intensity) * intensity * 0.01 + 0.5)
+                                + self.min_intensity)
+
+    def set_signal_length(self, signal_length):
+        self.on_time = signal_length
+
+    def activate(self, now):
+        self._set_state(ON, now)
+
+    def apply_signal(self, now):
+        self.end_time = now + self.on_time
+
+    def deactivate(self, now):
+        if self.state != DEACTIVATING:
+            self._set_state(DEACTIVATING, now)
+            self.deactivating_time = now + DEACTIVATING_TIME
+
+    def check(self, now):
+        if self.state == ON and self.end_time and self.end_time <= now:
+            self.deactivate(self.end_time)
+        if self.state == DEACTIVATING and self.deactivating_time and self.deactivating_time <= now:
+            self._set_state(OFF, self.deactivating_time)
+            self.end_time = 0
+            self.deactivating_time = 0
+            return 1
+        return 0
+
+
+class EMSDevice:
+    """Mirror of EMSSystem that records every channel state change.
+
+    transitions holds (time_ms, channel, state, intensity_percent) tuples in
+    the order they happened. The clock returns milliseconds and defaults to
+    the monotonic clock.
+    """
+
+    def __init__(self, channels=CHANNEL_COUNT, clock=None):
+        self.clock = clock or (lambda: time.monotonic() * 1000)
+        self.transitions = []
+        self.channels = [EmulatedChannel(i, self.transitions) for i in range(channels)]
+        # (time_ms, command) for every write, frames as their ASCII equivalent
+        self.commands = []
+        self.frames = 0
+
+    def check(self, now=None):
+        now = self.clock() if now is None else now
+        return sum(channel.check(now) for channel in self.channels)
+
+    def write(self, payload, now=None):
+        now = self.clock() if now is None else now
+        self.check(now)
+        if isinstance(payload, (bytes, bytearray)) and framing.is_frame(payload):
+            self.do_frame(payload, now)
+            return
+        command = payload.decode("latin-1") if isinstance(payload, (bytes, bytearray)) else payload
+        self.do_command(command, now)
+
+    def do_frame(self, payload, now):
+        """Binary frame decoder, every masked channel is applied like its ASCII command."""
+        self.frames += 1
+        commands = framing.StateUpdate(framing.decode_frame(payload)).commands()
+        self.do_command("".join(commands), now)
+
+    def do_command(self, command, now):
+        self.commands.append((now, command))
+        if len(command) > 0:
+            if ACTION in command:
+                start = 0
+                end = command.find(ACTION)
+                while end != -1:
+                    self.do_action_command(command[start:end + 1], now)
+                    start = end + 1
+                    end = command.find(ACTION, start)
+            elif command[0] == OPTION:
+                self.set_option(command)
+
+    def do_action_command(self, command, now):
+        if len(command) == 0:
+            return
+
+        current_channel = -1
+        separator = command.find(CHANNEL)
+        if separator != -1:
+            current_channel = get_next_number_of_string(command, separator)
+        valid = 0 <= current_channel < len(self.channels)
+
+        separator = command.find(TIME)
+        if separator != -1:
+            signal_length = get_next_number_of_string(command, separator)
+            if signal_length > MAX_SIGNAL_LENGTH:
+                signal_length = MAX_SIGNAL_LENGTH
+            if valid:
+                self.channels[current_channel].set_signal_length(signal_length)
+
+        separator = command.find(INTENSITY)
+        if separator != -1:
+            signal_intensity = get_next_number_of_string(command, separator)
+            if valid:
+                self.channels[current_channel].set_intensity(signal_intensity - 1)
+
+        if valid:
+            self.channels[current_channel].activate(now)
+            self.channels[current_channel].apply_signal(now)
+        else:
+            self.shut_down(now)
+
+    def set_option(self, option):
+        channel, value = self._channel_and_value(option)
+        if channel is None or len(option) < 3:
+            return
+        if option[1:3] == "MA":
+            self.channels[channel].max_intensity = _uint8(POTI_STEPS_UP * value * 0.01 + 0.5)
+        elif option[1:3] == "MI":
+            self.channels[channel].min_intensity = _uint8(POTI_STEPS_UP * value * 0.01 + 0.5)
+
+    def _channel_and_value(self, option):
+        left = option.find("[")
+        right = option.rfind("]")
+        separator = option.find(",", left + 1)
+        if -1 in (left, right, separator) or not left < separator < right:
+            return None, None
+        try:
+            channel = int(option[left + 1:separator])
+            value = int(option[separator + 1:right])
+        except ValueError:
+            return None, None
+        return (channel, value) if 0 <= channel < len(self.channels) else (None, None)
+
+    def shut_down(self, now=None):
+        now = self.clock() if now is None else now
+        for channel in self.channels:
+            channel.deactivate(now)
+
+    def intensities(self, now=None):
+        """Current intensity per channel in percent, 0 for channels that are not on."""
+        self.check(now)
+        return [channel.percent if channel.state == ON else 0 for channel in self.channels]
+
+    def running(self, now=None):
+        """Whether each channel is on, also for commanded intensity 1 that runs at percent 0."""
+        self.check(now)
+        return [channel.state == ON for channel in self.channels]
+
+
+_devices = {}
+
+
+def get_device(address, channels=CHANNEL_COUNT):
+    """The emulated toolkit behind address, kept across reconnects."""
+    if address not in _devices:
+        _devices[address] = EMSDevice(channels)
+    return _devices[address]
+
+
+class _Characteristic:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.properties = ["write", "write-without-response"]
+
+
+class _Service:
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid
+        self.characteristics = characteristics
+
+
+class EmulatedClient:
+    """Drop-in for BleakClient that delivers writes to an EMSDevice.
+
+    latency and jitter are in seconds, loss is the probability that a write is
+    lost on the link. Defaults come from EMS_EMULATOR_LATENCY_MS,
+    EMS_EMULATOR_JITTER_MS and EMS_EMULATOR_LOSS. The device applies every
+    command of a write, like the toolkit firmware of this repository, and
+    advertises it unless packed_commands is False (EMS_EMULATOR_PACKED=0).
+    """
+
+    def __init__(self, address, device=None, latency=None, jitter=None, loss=None, seed=None,
+                 disconnected_callback=None, binary_frames=None, packed_commands=None):
+        self.address = address
+        self.device = device if device is not None else get_device(address)
+        self.latency = float(os.environ.get("EMS_EMULATOR_LATENCY_MS", "0")) / 1000 if latency is None else latency
+        self.jitter = float(os.environ.get("EMS_EMULATOR_JITTER_MS", "0")) / 1000 if jitter is None else jitter
+        self.loss = float(os.environ.get("EMS_EMULATOR_LOSS", "0")) if loss is None else loss
+        # Like the firmware, binary frames are not advertised unless enabled (EMS_EMULATOR_BINARY=1)
+        self.binary_frames = os.environ.get("EMS_EMULATOR_BINARY", "") not in ("", "0") \
+            if binary_frames is None else binary_frames
+        self.packed_commands = os.environ.get("EMS_EMULATOR_PACKED", "1") not in ("", "0") \
+            if packed_commands is None else packed_commands
+        self.random = random.Random(seed)
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        # Set to False to make connect attempts fail, e.g. to test reconnects
+        self.available = True
+        characteristics = [_Characteristic(CHARACTERISTIC_UUID)]
+        if self._features():
+            characteristics.append(_Characteristic(framing.FEATURES_UUID))
+        self.services = [_Service(SERVICE_UUID, characteristics)]
+        self.writes = 0
+        self.lost = 0
+
+    def _features(self):
+        return ((framing.FEATURE_BINARY_FRAMES if self.binary_frames else 0)
+                | (framing.FEATURE_PACKED_COMMANDS if self.packed_commands else 0))
+
+    async def connect(self, timeout=10.0):
+        await self._link_delay()
+        if not self.available:
+            raise ConnectionError(f"Emulated device {self.address} is not available.")
+        self.is_connected = True
+        return True
+
+    async def drop_link(self):
+        """Simulate the toolkit going out of range, it stays unavailable until available is set again."""
+        self.available = False
+        await self.disconnect()
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.is_connected = False
+            # The firmware shuts all channels down on "Connection End"
+            self.device.shut_down()
+            if self.disconnected_callback:
+                self.disconnected_callback(self)
+        return True
+
+    async def read_gatt_char(self, char_specifier):
+        if not self.is_connected:
+            raise ConnectionError("Emulated device not connected.")
+        uuid = str(getattr(char_specifier, "uuid", char_specifier)).replace("-", "").lower()
+        if uuid == framing.FEATURES_UUID and self._features():
+            await self._link_delay()
+            return bytearray([self._features()])
+        raise ValueError(f"Characteristic {char_specifier} was not found.")
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        if not self.is_connected:
+            raise ConnectionError("Emulated device not connected.")
+        if str(getattr(char_specifier, "uuid", char_specifier)).replace("-", "").lower() != CHARACTERISTIC_UUID:
+            raise ValueError(f"Characteristic {char_specifier} was not found.")
+
+        await self._link_delay()
+        self.writes += 1
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            if response:
+                raise TimeoutError("Emulated write was lost.")
+            return
+        self.device.write(bytes(data))
+
+    async def _link_delay(self):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
@@ -0,0 +1,118 @@
+import asyncio
+import re
+import time
+from collections import deque
+
+from SharedFiles import runtime
+from SharedFiles.bluetooth import BluetoothHandler
+from SharedFiles.framing import StateUpdate
+from SharedFiles.log import get_logger
+from SharedFiles.supervisor import ConnectionSupervisor
+
+_ROUTED = re.compile(r"(?P<device>[^:]+):(?P<command>.*)", re.DOTALL)
+
+log = get_logger("fanout")
+
+
+def supervised_handler(address):
+    return ConnectionSupervisor(BluetoothHandler(address))
+
+
+class DeviceManager:
+    """Drives several toolkits at once.
+
+    devices maps a device name to its address (a plain list of addresses is named
+    device1, device2, ...). Commands prefixed with a device name, e.g.
+    "device2:C1I100T500G", go to that device only; logical channel names from
+    channel_map (e.g. {"left_arm": "device2:C1"}) can be used as prefix instead.
+    Commands without a prefix are broadcast to every device.
+    """
+
+    def __init__(self, devices, channel_map=None, handler_factory=supervised_handler, max_samples=1000):
+        if not isinstance(devices, dict):
+            devices = {f"device{i + 1}": address for i, address in enumerate(devices)}
+        self.addresses = dict(devices)
+        self.handlers = {name: handler_factory(address) for name, address in self.addresses.items()}
+        self.channel_map = dict(channel_map or {})
+        self.connect_ms = None
+        self.last_spread_ms = None
+        self.spreads_ms = deque(maxlen=max_samples)
+        self.throttle = runtime.Throttle(
+            min((getattr(handler, "max_pending", 64) for handler in self.handlers.values()), default=64))
+
+    async def connect(self, timeout=10.0):
+        """Connect all devices in parallel, raises if any of them fails."""
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(handler.connect(timeout=timeout) for handler in self.handlers.values()), return_exceptions=True)
+        self.connect_ms = (time.perf_counter() - start) * 1000
+        failed = {name: e for name, e in zip(self.handlers, results) if isinstance(e, Exception)}
+        if failed:
+            raise ConnectionError("Failed to connect: " + ", ".join(f"{n} ({e})" for n, e in failed.items()))
+        log.info("Connected %d devices in %.0f ms.", len(self.handlers), self.connect_ms)
+
+    async def disconnect(self):
+        await asyncio.gather(*(handler.disconnect() for handler in self.handlers.values()),
+                             return_exceptions=True)
+
+    def route(self, command):
+        """(device name, command without prefix) for a routed command, (None, command) for a broadcast."""
+        match = _ROUTED.fullmatch(command)
+        if not match:
+            return None, command
+        target, rest = match.group("device"), match.group("command")
+        if target in self.channel_map:
+            target, _, channel = self.channel_map[target].partition(":")
+            # The logical channel replaces the channel of the command
+            rest = re.sub(r"^C\d+", channel, rest) if rest.startswith("C") else channel + rest
+        if target not in self.handlers:
+            raise KeyError(f"Unknown device: {target}")
+        return target, rest
+
+    async def send(self, data, force=False):
+        if isinstance(data, StateUpdate) or (isinstance(data, (bytes, bytearray)) and b":" not in data):
+            return await self.broadcast(data, force)
+        command = data.decode() if isinstance(data, (bytes, bytearray)) else data
+        name, command = self.route(command)
+        if name is None:
+            return await self.broadcast(command, force)
+        return await self.handlers[name].send(command, force)
+
+    def submit(self, data, force=False):
+        """send() from any thread, returns a concurrent future; waits while too many are unfinished."""
+        return self.throttle.submit(self.send(data, force))
+
+    async def broadcast(self, command, force=False):
+        """Send command to all devices at once, returns False if any of them dropped it.
+
+        The spread of the write completion times is recorded, see stats().
+        """
+        done = {}
+
+        async def _send(name, handler):
+            result = await handler.send(command, force)
+            done[name] = time.perf_counter()
+            return result
+
+        results = await asyncio.gather(*(_send(name, handler) for name, handler in self.handlers.items()))
+        self.last_spread_ms = (max(done.values()) - min(done.values())) * 1000
+        self.spreads_ms.append(self.last_spread_ms)
+        return all(result is not False for result in results)
+
+    def stats(self):
+        stats = {name: handler.stats() for name, handler in self.handlers.items() if hasattr(handler, "stats")}
+        stats["connect_ms"] = self.connect_ms
+        spreads = sorted(self.spreads_ms)
+        stats["last_spread_ms"] = self.last_spread_ms
+        stats["p50_spread_ms"] = spreads[len(spreads) // 2] if spreads else None
+        stats["max_spread_ms"] = spreads[-1] if spreads else None
+        return stats
+
+
+def create_handler(addresses):
+    """A supervised handler for one address, a DeviceManager broadcasting to all of them for several."""
+    if isinstance(addresses, str):
+        addresses = [a.strip() for a in addresses.split(",") if a.strip()]
+    if len(addresses) == 1:
+        return supervised_handler(addresses[0])
+    return DeviceManager(addresses)
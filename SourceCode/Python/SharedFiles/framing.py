@@ -0,0 +1,119 @@
+"""Optional binary framing that updates several channels in one write.
+
+A frame is FRAME_MAGIC, a channel mask byte and, for every channel of the
+device, intensity (uint8) and duration in ms (uint16, little endian): 8 bytes
+for the two channel toolkit, against two ASCII commands of up to 13 bytes
+each. Channels not in the mask are left alone. Each masked channel behaves
+exactly like the ASCII command C<n>I<intensity>T<duration>G.
+
+Devices advertise support by exposing FEATURES_UUID with FEATURE_BINARY_FRAMES
+set. The toolkit firmware does not, so handlers fall back to ASCII commands.
+FEATURE_PACKED_COMMANDS tells that one write may carry several ASCII commands.
+The firmware in this repository advertises it; the stock firmware has no
+features characteristic and only applies the first command of a write, so
+handlers write every command on its own then.
+"""
+import struct
+from functools import lru_cache
+
+from SharedFiles.commands import CACHE_SIZE, CHANNEL_COUNT, command, validate
+
+FRAME_MAGIC = 0xE5
+FEATURES_UUID = "454d532d46656174757265732d424c45"
+FEATURE_BINARY_FRAMES = 0x01
+FEATURE_PACKED_COMMANDS = 0x02
+MAX_FRAME_CHANNELS = 8
+_ENTRY = struct.Struct("<BH")
+
+
+class StateUpdate:
+    """Intensity and duration for several channels that should change together."""
+
+    __slots__ = ("channels", "force")
+
+    def __init__(self, channels, force=False):
+        # {channel: (intensity, duration_ms)}
+        self.channels = dict(sorted(channels.items()))
+        # Sent even if the handler's DeviceMirror considers it redundant
+        self.force = force
+
+    def __repr__(self):
+        return f"StateUpdate({self.channels})"
+
+    def __eq__(self, other):
+        return isinstance(other, StateUpdate) and self.channels == other.channels
+
+    def __hash__(self):
+        return hash(tuple(self.channels.items()))
+
+    @classmethod
+    def off(cls, channels=None, force=True):
+        """Turns channels (all by default) off, forced by default since stopping is safety critical."""
+        return cls({channel: (0, 0) for channel in (range(CHANNEL_COUNT) if channels is None else channels)}, force)
+
+    def commands(self):
+        """The equivalent ASCII commands, one per channel."""
+        return [payload.decode() for payload in self.payloads(MAX_FRAME_CHANNELS)]
+
+    def payloads(self, channel_count=CHANNEL_COUNT):
+        """The equivalent encoded ASCII commands, validated and cached."""
+        return [command(channel, intensity, duration, channel_count)
+                for channel, (intensity, duration) in self.channels.items()]
+
+    def frame(self, channel_count=CHANNEL_COUNT):
+        return _cached_frame(tuple(self.channels.items()), channel_count)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cached_frame(items, channel_count):
+    return encode_frame(dict(items), channel_count)
+
+
+def encode_frame(channels, channel_count=CHANNEL_COUNT):
+    if not 0 < channel_count <= MAX_FRAME_CHANNELS:
+        raise ValueError(f"Frames support 1 to {MAX_FRAME_CHANNELS} channels.")
+    mask = 0
+    entries = [(0, 0)] * channel_count
+    for channel, (intensity, duration) in channels.items():
+        validate(channel, intensity, duration, channel_count)
+        mask |= 1 << channel
+        entries[channel] = (intensity, duration)
+    return bytes((FRAME_MAGIC, mask)) + b"".join(_ENTRY.pack(i, d) for i, d in entries)
+
+
+def is_frame(payload):
+    return len(payload) > 0 and payload[0] == FRAME_MAGIC
+
+
+def decode_frame(payload):
+    """{channel: (intensity, duration_ms)} for the channels in the mask."""
+    if not is_frame(payload) or len(payload) < 2 or (len(payload) - 2) % _ENTRY.size:
+        raise ValueError(f"Not a frame: {bytes(payload)!r}")
+    mask = payload[1]
+    channels = {}
+    for channel in range((len(payload) - 2) // _ENTRY.size):
+        if mask & (1 << channel):
+            channels[channel] = _ENTRY.unpack_from(payload, 2 + channel * _ENTRY.size)
+    return channels
+
+
+def as_commands(command):
+    """ASCII command strings for a str, bytes or StateUpdate command."""
+    if isinstance(command, StateUpdate):
+        return command.commands()
+    if isinstance(command, (bytes, bytearray)):
+        command = command.decode("latin-1")
+    return [part + "G" for part in command.split("G")[:-1]] or [command]
+
+
+async def read_features(client):
+    """Reads the feature bits of the features characteristic, 0 if the device has none."""
+    try:
+        features = await client.read_gatt_char(FEATURES_UUID)
+    except Exception:
+        return 0
+    return features[0] if features else 0
+
+
+async def supports_binary_frames(client):
+    return bool(await read_features(client) & FEATURE_BINARY_FRAMES)
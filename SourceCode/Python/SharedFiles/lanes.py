@@ -0,0 +1,116 @@
+import asyncio
+from collections import deque
+
+# Emergency stop: skips ahead of everything else and never waits for queue space
+STOP = 0
+# Channel state changes, written in the order they were sent
+STATE = 1
+# Anything that may wait, e.g. keepalives
+BEST_EFFORT = 2
+PRIORITIES = (STOP, STATE, BEST_EFFORT)
+
+
+class PriorityLanes:
+    """One FIFO per priority, get() returns (priority, item) for the oldest item of the most urgent lane.
+
+    put() waits while max_pending items are queued, so a fast producer is slowed
+    down instead of growing the queue without bound. STOP items are exempt.
+    """
+
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self._lanes = [deque() for _ in PRIORITIES]
+        self._size = 0
+        self._unfinished = 0
+        self._ready = asyncio.Event()
+        # Producers waiting for space, woken one at a time like asyncio.Queue does
+        self._putters = deque()
+        self._stop = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def __len__(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    async def put(self, item, priority):
+        while priority != STOP and self._size >= self.max_pending:
+            putter = asyncio.get_running_loop().create_future()
+            self._putters.append(putter)
+            try:
+                await putter
+            except asyncio.CancelledError:
+                # Pass the wakeup on if this producer was given the free slot
+                if putter.done() and not putter.cancelled():
+                    self._wake_putter()
+                raise
+        self._lanes[priority].append(item)
+        self._size += 1
+        self._unfinished += 1
+        self._idle.clear()
+        self._ready.set()
+        if priority == STOP:
+            self._stop.set()
+
+    async def wait_unless_stopped(self, timeout):
+        """Sleep for timeout seconds, returns early once a STOP is queued."""
+        if self._lanes[STOP]:
+            return
+        self._stop.clear()
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def peek(self):
+        for lane in self._lanes:
+            if lane:
+                return lane[0]
+        return None
+
+    def get_nowait(self):
+        for priority, lane in zip(PRIORITIES, self._lanes):
+            if lane:
+                self._size -= 1
+                self._wake_putter()
+                return priority, lane.popleft()
+        raise IndexError("No queued items.")
+
+    async def get(self):
+        while self.empty():
+            self._ready.clear()
+            await self._ready.wait()
+        return self.get_nowait()
+
+    def remove(self, predicate, priorities=PRIORITIES):
+        """Take every queued item of the given priorities for which predicate(item) is true."""
+        removed = []
+        for priority in priorities:
+            lane = self._lanes[priority]
+            kept = deque()
+            for item in lane:
+                (removed if predicate(item) else kept).append(item)
+            self._lanes[priority] = kept
+        self._size -= len(removed)
+        for _ in removed:
+            self._wake_putter()
+        return removed
+
+    def _wake_putter(self):
+        while self._putters:
+            putter = self._putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+    def task_done(self, count=1):
+        self._unfinished -= count
+        if self._unfinished <= 0:
+            self._unfinished = 0
+            self._idle.set()
+
+    async def join(self):
+        """Wait until every item was taken and marked done."""
+        await self._idle.wait()
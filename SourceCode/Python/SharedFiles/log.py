@@ -0,0 +1,97 @@
+"""Logging for all apps, written by a background thread.
+
+Loggers from get_logger put their records on a queue; a QueueListener thread
+formats them and writes them to stdout and, with EMS_LOG_FILE, to a file. The
+thread is started by the first record that is logged, not on import. The
+level comes from EMS_LOG_LEVEL (INFO by default). Per-command messages are
+logged at DEBUG, so with the default level they are dropped by the level check
+before any formatting happens. Guard expensive arguments with
+log.isEnabledFor(DEBUG). Records are queued with their message and arguments
+unformatted, so arguments are read when the thread writes them; pass values
+that do not change afterwards.
+"""
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+ROOT = "ems"
+_records = None
+_path = None
+_handlers = None
+_listener = None
+_stopped = False
+_lock = threading.Lock()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # QueueHandler.prepare() formats on the calling thread; the listener's handlers format instead
+        return copy.copy(record)
+
+    def emit(self, record):
+        if _listener is None:
+            _start()
+        if _stopped:
+            # After shutdown records are written on the calling thread
+            for handler in _handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        super().emit(record)
+
+
+def setup(level=None, path=None):
+    """Configure the ems loggers once, later calls only change the level."""
+    global _records, _path
+    level = level or os.environ.get("EMS_LOG_LEVEL", "INFO")
+    root = logging.getLogger(ROOT)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    with _lock:
+        if _records is not None:
+            return root
+        _path = path or os.environ.get("EMS_LOG_FILE")
+        _records = queue.SimpleQueue()
+        root.addHandler(_QueueHandler(_records))
+        root.propagate = False
+    return root
+
+
+def _start():
+    global _handlers, _listener
+    with _lock:
+        if _listener is not None:
+            return
+        _handlers = [logging.StreamHandler(sys.stdout)]
+        if _path:
+            file_handler = logging.FileHandler(_path)
+            file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(threadName)s: %(message)s"))
+            _handlers.append(file_handler)
+        _listener = logging.handlers.QueueListener(_records, *_handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """Write out queued records and stop the writer thread."""
+    global _stopped
+    with _lock:
+        if _listener is None or _stopped:
+            return
+        _stopped = True
+    _listener.stop()
+
+
+def get_logger(name):
+    if _records is None:
+        setup()
+    return logging.getLogger(ROOT + "." + name)
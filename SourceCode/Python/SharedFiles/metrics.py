@@ -0,0 +1,185 @@
+"""Latency histograms of the send path, exported to a file in the background.
+
+A Tracer keeps one Histogram per (device, channel, stage). BluetoothHandler
+records, for every command, the stages
+  queue:   send() called -> taken from the queue by the writer
+  wait:    taken from the queue -> GATT write started (coalescing)
+  write:   GATT write started -> completed
+  total:   send() called -> write completed
+and the app helpers add
+  handoff: helper called on the app thread -> send() running on the runtime.
+Set EMS_METRICS to a file (.json for JSON, anything else for a text table) to
+trace every handler of a process; it is rewritten every EMS_METRICS_INTERVAL
+seconds (10 by default). Recording is a few integer operations per command.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from SharedFiles.commands import decode
+from SharedFiles.framing import StateUpdate, decode_frame, is_frame
+from SharedFiles.log import get_logger
+
+# Bucket upper bounds in microseconds: 16 us, 32 us, ... about 17 s
+BUCKETS_US = [16 << i for i in range(21)]
+
+_default = None
+_default_lock = threading.Lock()
+
+log = get_logger("metrics")
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total_us", "max_us")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_US) + 1)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def record(self, value_us):
+        self.counts[bisect_left(BUCKETS_US, value_us)] += 1
+        self.count += 1
+        self.total_us += value_us
+        if value_us > self.max_us:
+            self.max_us = value_us
+
+    def percentile_ms(self, p):
+        """Upper bound of the bucket holding the p-th percentile."""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_US + [self.max_us], self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max_us) / 1000
+        return self.max_us / 1000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total_us / self.count / 1000 if self.count else None,
+            "p50_ms": self.percentile_ms(50),
+            "p90_ms": self.percentile_ms(90),
+            "p99_ms": self.percentile_ms(99),
+            "max_ms": self.max_us / 1000,
+            "buckets_us": dict(zip([str(b) for b in BUCKETS_US] + ["inf"], self.counts)),
+        }
+
+
+def channel_key(command):
+    """Channel label of a command: "0", "1", "0+1" for several, "-" for other payloads."""
+    if isinstance(command, StateUpdate):
+        channels = command.channels
+    else:
+        payload = command.encode() if isinstance(command, str) else bytes(command)
+        if is_frame(payload):
+            channels = decode_frame(payload)
+        else:
+            parsed = decode(payload)
+            channels = {part[0]: None for part in parsed} if parsed else ()
+    return "+".join(str(channel) for channel in sorted(channels)) or "-"
+
+
+class Tracer:
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+
+    def record(self, device, channel, stage, duration_ns):
+        key = (device, channel, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.record(duration_ns // 1000)
+
+    def snapshot(self):
+        """{device: {channel: {stage: summary}}}"""
+        result = {}
+        for (device, channel, stage), histogram in list(self.histograms.items()):
+            result.setdefault(device, {}).setdefault(channel, {})[stage] = histogram.summary()
+        return result
+
+    def to_text(self):
+        lines = [f"{'device':<40} {'channel':<7} {'stage':<8} {'count':>8} {'mean':>8} {'p50':>8} "
+                 f"{'p99':>8} {'max':>8}  (ms)"]
+        for device, channels in sorted(self.snapshot().items()):
+            for channel, stages in sorted(channels.items()):
+                for stage, s in sorted(stages.items()):
+                    lines.append(f"{device:<40} {channel:<7} {stage:<8} {s['count']:>8} {s['mean_ms']:>8.3f} "
+                                 f"{s['p50_ms']:>8.3f} {s['p99_ms']:>8.3f} {s['max_ms']:>8.3f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        if path.endswith(".json"):
+            content = json.dumps({"started": self.started, "written": time.time(),
+                                  "histograms": self.snapshot()}, indent=2)
+        else:
+            content = self.to_text()
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+
+class MetricsExporter:
+    """Rewrites path with the tracer's histograms every interval seconds on a daemon thread."""
+
+    def __init__(self, tracer, path, interval=10.0):
+        self.tracer = tracer
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ems-metrics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            self.tracer.write(self.path)
+        except OSError as e:
+            log.warning("Could not write metrics: %s", e)
+
+    def stop(self):
+        self._stopped.set()
+        self.write()
+
+
+def default_tracer():
+    """The process wide tracer for EMS_METRICS, None if it is not set."""
+    global _default
+    path = os.environ.get("EMS_METRICS")
+    if not path:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = Tracer()
+            exporter = MetricsExporter(_default, path, float(os.environ.get("EMS_METRICS_INTERVAL", "10"))).start()
+            atexit.register(exporter.stop)
+    return _default
+
+
+def submit_send(handler, message, tracer=None):
+    """handler.submit(message) that also records the hand-over to the runtime thread."""
+    tracer = tracer or default_tracer()
+    if tracer is None:
+        return handler.submit(message)
+    submitted = time.perf_counter_ns()
+
+    async def _send():
+        tracer.record(getattr(handler, "address", "all"), channel_key(message), "handoff",
+                      time.perf_counter_ns() - submitted)
+        return await handler.send(message)
+
+    return handler.throttle.submit(_send())
@@ -0,0 +1,65 @@
+import time
+
+from SharedFiles.commands import CHANNEL_COUNT
+
+
+class DeviceMirror:
+    """Client-side model of what each channel of the toolkit is doing.
+
+    Every command that is sent updates the intensity of its channel and when the
+    signal is expected to end (now + T). A command that would not change that
+    state is redundant: an off for a channel whose last command was an off, or
+    an on at the same intensity that ends within tolerance_ms of the running
+    signal. Expiry is counted from when the command was queued, the device
+    only starts counting once the write lands, so an off is never elided just
+    because the signal should have run out by now. After a (re)connect or a
+    failed write the state is unknown and nothing is elided.
+    """
+
+    def __init__(self, channel_count=CHANNEL_COUNT, tolerance_ms=50.0, clock=None):
+        self.tolerance_ms = tolerance_ms
+        self.clock = clock or (lambda: time.monotonic() * 1000)
+        # (intensity, expires_at_ms) per channel, None while unknown
+        self.channels = [None] * channel_count
+        self.sent = 0
+        self.saved = 0
+
+    def reset(self):
+        self.channels = [None] * len(self.channels)
+
+    def is_off(self, channel, now=None):
+        state = self.channels[channel]
+        if state is None:
+            return False
+        now = self.clock() if now is None else now
+        return state[0] == 0 or state[1] + self.tolerance_ms <= now
+
+    def redundant(self, channel, intensity, duration, now=None):
+        now = self.clock() if now is None else now
+        state = self.channels[channel]
+        if state is None:
+            return False
+        if intensity == 0 or duration == 0:
+            return state[0] == 0
+        return (not self.is_off(channel, now) and state[0] == intensity
+                and abs(state[1] - (now + duration)) <= self.tolerance_ms)
+
+    def filter(self, updates, force=False):
+        """The {channel: (intensity, duration)} entries that change the device, applied to the model."""
+        now = self.clock()
+        changed = {}
+        for channel, (intensity, duration) in updates.items():
+            if not 0 <= channel < len(self.channels):
+                # Not modelled, left to the command validation
+                changed[channel] = (intensity, duration)
+                continue
+            if not force and self.redundant(channel, intensity, duration, now):
+                self.saved += 1
+                continue
+            self.channels[channel] = (intensity if duration else 0, now + duration)
+            changed[channel] = (intensity, duration)
+        self.sent += len(changed)
+        return changed
+
+    def stats(self):
+        return {"mirror_sent": self.sent, "mirror_saved": self.saved}
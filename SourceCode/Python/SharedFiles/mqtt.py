@@ -1,5 +1,6 @@
-from paho.mqtt.client import Client
-from asyncio import run
+from SharedFiles.log import get_logger
+
+log = get_logger("mqtt")
 
 class MQTTReceiver:
     def __init__(self, broker_address, topic, on_message_callback=None):
@@ -7,30 +8,24 @@ class MQTTReceiver:
         self.topic = topic
         self.on_message_callback = on_message_callback
 
+        # paho is only needed once a receiver is created
+        from paho.mqtt.client import Client
         self.client = Client()
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
 
     def _on_connect(self, client, userdata, flags, rc):
-        print(f"MQTT connected with result code {rc}")
+        log.info("MQTT connected with result code %s", rc)
         self.client.subscribe(self.topic)
 
     def _on_message(self, client, userdata, msg):
         message = msg.payload.decode()
-        print(f"Recveived MQTT: {message}")
+        log.debug("Received MQTT: %s", message)
 
+        # Forwarding to BLE is done by SharedFiles.bridge.MQTTBridge
         if self.on_message_callback:
             self.on_message_callback(message)
 
-        # # Send BLE message
-        # try:
-        #     if self.ble_handler and self.ble_handler.client.is_connected:
-        #         run(self.ble_handler.send(message))
-        #     else:
-        #         print("BLE not connected.")
-        # except Exception as e:
-        #     print("Failed to send over BLE:", e)
-
     def start(self):
         self.client.connect(self.broker_address)
         self.client.loop_start()
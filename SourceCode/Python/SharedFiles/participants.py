@@ -0,0 +1,60 @@
+"""Calibration results per participant, kept in a small JSON file.
+
+The file lives in ~/.ems_simulation/participants.json unless
+EMS_PARTICIPANTS_FILE points somewhere else.
+"""
+import json
+import os
+import time
+
+from SharedFiles.log import get_logger
+
+RESULTS_PATH = os.environ.get(
+    "EMS_PARTICIPANTS_FILE", os.path.join(os.path.expanduser("~"), ".ems_simulation", "participants.json"))
+VERSION = 1
+
+log = get_logger("participants")
+
+
+def load(path=None):
+    path = path or RESULTS_PATH
+    try:
+        with open(path) as f:
+            results = json.load(f)
+        if results.get("version") == VERSION:
+            return results
+    except (OSError, ValueError):
+        pass
+    return {"version": VERSION, "participants": {}}
+
+
+def save(results, path=None):
+    path = path or RESULTS_PATH
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(results, f, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning("Could not write participant results: %s", e)
+
+
+def remember_calibration(participant, thresholds, engine, trials, path=None):
+    """Store the thresholds ({channel: intensity}) found for a participant."""
+    results = load(path)
+    results["participants"][participant] = {
+        "thresholds": {str(channel): intensity for channel, intensity in thresholds.items()},
+        "engine": engine,
+        "trials": trials,
+        "calibrated": time.time(),
+    }
+    save(results, path)
+
+
+def calibration(participant, path=None):
+    """{channel: intensity} of the last calibration of participant, None if there is none."""
+    entry = load(path)["participants"].get(participant)
+    if not entry:
+        return None
+    return {int(channel): intensity for channel, intensity in entry["thresholds"].items()}
@@ -0,0 +1,227 @@
+"""Stimulation patterns as per-channel intensity envelopes.
+
+An envelope is a list of (time_ms, level) breakpoints, linear in between and
+zero outside of them. Levels are fractions of the channel's intensity, so the
+same pattern plays with any calibration. Two breakpoints at the same time make
+a step. compile_pattern samples the envelopes with NumPy and turns them into
+Timeline events: one StateUpdate per sample at which any channel changes,
+never more than max_rate per second, and each command's duration reaching
+to the end of the channel's run, so the firmware needs no keep-alives.
+
+Compiled patterns are cached per (pattern, intensities, max_rate);
+precompile() fills the cache for the patterns in COMMON, e.g. on connect.
+"""
+import math
+from functools import lru_cache
+
+import numpy as np
+
+from SharedFiles.commands import CACHE_SIZE, MAX_DURATION, MAX_INTENSITY
+from SharedFiles.framing import StateUpdate
+
+# Upper bound for the commands per second of a compiled pattern
+MAX_RATE = 50
+# Samples of a ramp are at most this far apart, even if the intensity barely changes
+MAX_STEP_MS = 1000
+# Runs longer than the firmware maximum are refreshed this often
+REFRESH_MS = 20000
+
+
+class Pattern:
+    """Immutable envelopes {channel: ((time_ms, level), ...)} and a duration in ms."""
+    __slots__ = ("envelopes", "duration")
+
+    def __init__(self, envelopes, duration=None):
+        self.envelopes = tuple(sorted(
+            (channel, tuple((float(t), float(level)) for t, level in points))
+            for channel, points in envelopes.items() if points))
+        for channel, points in self.envelopes:
+            if any(b[0] < a[0] for a, b in zip(points, points[1:])):
+                raise ValueError(f"Breakpoints of channel {channel} are not in time order.")
+            if any(not 0 <= level <= 1 for _, level in points):
+                raise ValueError(f"Levels of channel {channel} must be within 0..1.")
+        end = max((points[-1][0] for _, points in self.envelopes), default=0.0)
+        self.duration = float(end if duration is None else max(duration, end))
+
+    def __eq__(self, other):
+        return isinstance(other, Pattern) and (self.envelopes, self.duration) == (other.envelopes, other.duration)
+
+    def __hash__(self):
+        return hash((self.envelopes, self.duration))
+
+    def __repr__(self):
+        return f"Pattern({dict(self.envelopes)}, duration={self.duration:g})"
+
+    @property
+    def channels(self):
+        return tuple(channel for channel, _ in self.envelopes)
+
+    def then(self, other):
+        """This pattern followed by other."""
+        envelopes = {channel: list(points) for channel, points in self.envelopes}
+        for channel, points in other.envelopes:
+            envelopes.setdefault(channel, []).extend((t + self.duration, level) for t, level in points)
+        return Pattern(envelopes, self.duration + other.duration)
+
+    def overlay(self, other):
+        """Both patterns at once, they must not share a channel."""
+        shared = set(self.channels) & set(other.channels)
+        if shared:
+            raise ValueError(f"Both patterns use channel(s) {sorted(shared)}.")
+        return Pattern(dict(self.envelopes + other.envelopes), max(self.duration, other.duration))
+
+
+def silence(duration_ms):
+    """Nothing for duration_ms, e.g. to delay a pattern with silence(ms).then(pattern)."""
+    return Pattern({}, duration_ms)
+
+
+def constant(channels, duration_ms, level=1.0):
+    return Pattern({channel: [(0, level), (duration_ms, level)] for channel in channels}, duration_ms)
+
+
+def ramp(channel, start, end, duration_ms):
+    return Pattern({channel: [(0, start), (duration_ms, end)]}, duration_ms)
+
+
+def fade_out(channel, duration_ms=500):
+    return ramp(channel, 1.0, 0.0, duration_ms)
+
+
+def pulses(channels, on_ms, off_ms, count, level=1.0):
+    points = []
+    for i in range(count):
+        start = i * (on_ms + off_ms)
+        points += [(start, 0.0), (start, level), (start + on_ms, level), (start + on_ms, 0.0)]
+    return Pattern({channel: points for channel in channels}, count * (on_ms + off_ms) - off_ms)
+
+
+def crossfade(duration_ms, source=0, target=1, hold_ms=0, equal_power=True, steps=16):
+    """Moves the sensation from source to target, holding it hold_ms on either end.
+
+    equal_power keeps level_source² + level_target² constant, which keeps the
+    perceived strength steadier in the middle than a linear fade.
+    """
+    x = np.linspace(0.0, 1.0, steps + 1 if equal_power else 2)
+    rising = np.sin(x * np.pi / 2) if equal_power else x
+    falling = np.cos(x * np.pi / 2) if equal_power else 1 - x
+    times = hold_ms + x * duration_ms
+    end = 2 * hold_ms + duration_ms
+    return Pattern({
+        source: [(0, 1.0)] + list(zip(times, np.clip(falling, 0, 1))),
+        target: list(zip(times, np.clip(rising, 0, 1))) + [(end, 1.0)],
+    }, end)
+
+
+def _sample(times, levels, at):
+    """Envelope values at the times in at; right-continuous at steps, zero outside."""
+    after = np.searchsorted(times, at, side="right")
+    lo = np.clip(after - 1, 0, len(times) - 1)
+    hi = np.clip(after, 0, len(times) - 1)
+    span = times[hi] - times[lo]
+    fraction = np.divide(at - times[lo], span, out=np.zeros_like(at), where=span > 0)
+    values = levels[lo] + (levels[hi] - levels[lo]) * fraction
+    values[(after == 0) | (after == len(times))] = 0.0
+    return values
+
+
+def step_ms(pattern, intensities, max_rate=MAX_RATE):
+    """Sample spacing: one intensity unit per step on the steepest ramp, within the rate limit."""
+    floor = 1000 / max_rate
+    finest = MAX_STEP_MS
+    for channel, points in pattern.envelopes:
+        times, levels = np.asarray(points).T
+        dt = np.diff(times)
+        units = np.abs(np.diff(levels)) * intensities.get(channel, 0)
+        ramps = (dt > 0) & (units >= 1)
+        if ramps.any():
+            finest = min(finest, float((dt[ramps] / units[ramps]).min()))
+    # A multiple of floor, so that every sample sits on the floor grid
+    return max(1, math.floor(finest / floor)) * floor
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _compile(pattern, intensities, max_rate):
+    intensities = dict(intensities)
+    floor = 1000 / max_rate
+    step = step_ms(pattern, intensities, max_rate)
+
+    # Breakpoints are sampled where they are but sent at the nearest floor
+    # slot, uniform samples fill the ramps in between
+    breaks = np.unique(np.concatenate(
+        [np.asarray(points)[:, 0] for _, points in pattern.envelopes] + [[0.0, pattern.duration]]))
+    slots = np.rint(breaks / floor) * floor
+    uniform = np.arange(0.0, pattern.duration, step)
+    uniform = uniform[~np.isin(uniform, slots)]
+    offsets = np.concatenate([slots, uniform])
+    sample_at = np.concatenate([breaks, uniform])
+    # Several breakpoints in one slot: the last one wins
+    order = np.lexsort((sample_at, offsets))
+    offsets, sample_at = offsets[order], sample_at[order]
+    keep = np.append(offsets[1:] != offsets[:-1], True)
+    offsets, sample_at = offsets[keep], sample_at[keep]
+    # Nothing is sent after the pattern ended
+    sample_at[-1] = pattern.duration
+    offsets_ms = np.rint(offsets).astype(np.int64)
+
+    changes = []
+    for channel, points in pattern.envelopes:
+        times, levels = np.asarray(points).T
+        level = np.rint(_sample(times, levels, sample_at) * intensities.get(channel, 0))
+        level = np.clip(level, 0, MAX_INTENSITY).astype(np.int64)
+        level[-1] = 0
+
+        previous = np.concatenate([[0], level[:-1]])
+        block = offsets_ms // REFRESH_MS
+        refresh = np.concatenate([[False], block[1:] != block[:-1]]) & (level > 0)
+        send = (level != previous) | refresh
+
+        # Each command lasts until the next sample at which the channel is off
+        zeros = np.flatnonzero(level == 0)
+        run_end = offsets_ms[zeros[np.searchsorted(zeros, np.arange(len(level)), side="left")]]
+        duration = np.minimum(run_end - offsets_ms, MAX_DURATION)
+        duration[level == 0] = 0
+        changes.append((channel, send, level, duration))
+
+    events = []
+    for i in np.flatnonzero(np.any([send[:-1] for _, send, _, _ in changes], axis=0)):
+        update = {channel: (int(level[i]), int(duration[i]))
+                  for channel, send, level, duration in changes if send[i]}
+        events.append((int(offsets_ms[i]), StateUpdate(update)))
+    # The end is a forced off of every channel, sent as a stop and never elided
+    events.append((int(offsets_ms[-1]), StateUpdate.off(pattern.channels)))
+    return tuple(events)
+
+
+def compile_pattern(pattern, intensities, max_rate=MAX_RATE, offset_ms=0):
+    """Timeline events of pattern with intensities {channel: intensity}, shifted by offset_ms."""
+    # Keyed by the intensities of the pattern's own channels only
+    events = _compile(pattern, tuple((channel, intensities.get(channel, 0)) for channel in pattern.channels), max_rate)
+    if offset_ms:
+        return [(offset + offset_ms, update) for offset, update in events]
+    return list(events)
+
+
+# The stimuli of the study and the app. The flows are the original overlap:
+# the first channel 0-6 s and the second 3-9 s, both at full intensity.
+COMMON = {
+    "zone1": constant((0,), 5000),
+    "zone2": constant((0, 1), 5000),
+    "zone3": constant((1,), 5000),
+    "flow1": constant((0,), 6000).overlay(silence(3000).then(constant((1,), 6000))),
+    "flow2": constant((1,), 6000).overlay(silence(3000).then(constant((0,), 6000))),
+    "crossfade1": crossfade(3000, source=0, target=1, hold_ms=3000),
+    "crossfade2": crossfade(3000, source=1, target=0, hold_ms=3000),
+    "fade0": fade_out(0),
+    "fade1": fade_out(1),
+}
+
+
+def precompile(intensities, names=None, max_rate=MAX_RATE):
+    """Compiles the COMMON patterns for intensities ahead of their first use."""
+    for name in names or COMMON:
+        compile_pattern(COMMON[name], intensities, max_rate)
+
+
+def cache_info():
+    return _compile.cache_info()
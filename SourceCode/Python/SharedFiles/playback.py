@@ -0,0 +1,92 @@
+import asyncio
+from collections import deque
+
+from SharedFiles import runtime
+from SharedFiles.framing import StateUpdate
+from SharedFiles.log import DEBUG, get_logger
+from SharedFiles.timeline import Timeline
+
+OFF_COMMANDS = [StateUpdate.off()]
+
+log = get_logger("playback")
+
+
+class Player:
+    """Plays event lists one after another on the shared runtime.
+
+    play() and stop() may be called from any thread, e.g. the Tk main thread.
+    New event lists are queued behind the one that is playing. stop() clears
+    the queue, cancels the current playback and sends off_commands right away.
+    on_progress(message) is called from the runtime thread with messages about
+    whole event lists (started, queued, done, stopped), by default they are
+    logged. on_event(message) gets one message per command sent, by default
+    they are logged at DEBUG and not formatted at all when DEBUG is off.
+    """
+
+    def __init__(self, send, off_commands=OFF_COMMANDS, on_progress=None, on_event=None, max_queued=8):
+        self.send = send
+        self.off_commands = list(off_commands)
+        self.on_progress = on_progress
+        self.on_event = on_event
+        self.max_queued = max_queued
+        self.current = None
+        # Only touched on the runtime thread
+        self._jobs = deque()
+        self._worker = None
+
+    def play(self, events, label="gesture"):
+        runtime.call_soon(self._enqueue, list(events), label)
+
+    def stop(self):
+        return runtime.submit(self._stop())
+
+    @property
+    def busy(self):
+        return self.current is not None or bool(self._jobs)
+
+    def _enqueue(self, events, label):
+        if not events:
+            return
+        if len(self._jobs) >= self.max_queued:
+            self._progress(f"Playback queue full, {label} dropped.")
+            return
+        self._jobs.append((events, label))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        elif self.current is not None:
+            self._progress(f"{label} queued ({len(self._jobs)} waiting).")
+
+    async def _run(self):
+        while self._jobs:
+            events, label = self._jobs.popleft()
+            total = len(events)
+            on_event = None
+            if self.on_event is not None or log.isEnabledFor(DEBUG):
+                report = self.on_event or log.debug
+                on_event = lambda i, offset, command: report(
+                    f"{label}: {i + 1}/{total} at {offset / 1000:.1f} s ({command})")
+            self.current = Timeline(events, self.send, on_event=on_event)
+            self._progress(f"Playing {label} ({total} commands, {self.current.events[-1][0] / 1000:.1f} s).")
+            try:
+                await self.current.run()
+                self._progress(f"{label} done, max timing error {self.current.max_jitter_ms():.1f} ms.")
+            except Exception as e:
+                self._progress(f"{label} failed: {e}")
+            finally:
+                self.current = None
+
+    async def _stop(self):
+        dropped = len(self._jobs)
+        self._jobs.clear()
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self.current = None
+        await asyncio.gather(*(self.send(command) for command in self.off_commands))
+        self._progress(f"Stopped, channels off ({dropped} queued dropped).")
+
+    def _progress(self, message):
+        (self.on_progress or log.info)(message)
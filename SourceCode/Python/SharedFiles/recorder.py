@@ -0,0 +1,96 @@
+"""Append-only binary log of everything written to the toolkits.
+
+A log starts with MAGIC and holds records of a fixed header (kind, monotonic
+time in ns, device id, payload length, little endian) followed by the payload.
+A DEVICE record maps a device id to its address once, every WRITE record holds
+the bytes of one GATT write. Set EMS_SESSION_LOG to a file to record every
+BluetoothHandler of a process into it.
+"""
+import atexit
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"EMSLOG1\n"
+DEVICE = 0
+WRITE = 1
+_HEADER = struct.Struct("<BqHH")
+
+_default = None
+_default_lock = threading.Lock()
+
+
+class SessionRecorder:
+    """Appends records to path. Safe to share between handlers of one process."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._devices = {}
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "ab")
+        if new:
+            self._file.write(MAGIC)
+
+    def record(self, device, payload, timestamp_ns=None):
+        timestamp_ns = time.monotonic_ns() if timestamp_ns is None else timestamp_ns
+        with self._lock:
+            device_id = self._devices.get(device)
+            if device_id is None:
+                device_id = self._devices[device] = len(self._devices)
+                name = device.encode()
+                self._file.write(_HEADER.pack(DEVICE, timestamp_ns, device_id, len(name)) + name)
+            self._file.write(_HEADER.pack(WRITE, timestamp_ns, device_id, len(payload)) + payload)
+            self.records += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def default_recorder():
+    """The process wide recorder for EMS_SESSION_LOG, None if it is not set."""
+    global _default
+    path = os.environ.get("EMS_SESSION_LOG")
+    if not path:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = SessionRecorder(path)
+            atexit.register(_default.close)
+    return _default
+
+
+def read_session(path):
+    """(timestamp_ns, device, payload) for every write in the log, read through mmap."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a session log.")
+            devices = {}
+            records = []
+            offset = len(MAGIC)
+            end = len(data)
+            while offset + _HEADER.size <= end:
+                kind, timestamp_ns, device_id, length = _HEADER.unpack_from(data, offset)
+                offset += _HEADER.size
+                if offset + length > end:
+                    # Truncated last record, e.g. the process was killed while writing
+                    break
+                payload = data[offset:offset + length]
+                offset += length
+                if kind == DEVICE:
+                    devices[device_id] = payload.decode()
+                elif kind == WRITE:
+                    records.append((timestamp_ns, devices.get(device_id, str(device_id)), payload))
+            return records
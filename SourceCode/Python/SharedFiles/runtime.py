@@ -0,0 +1,119 @@
+"""Single asyncio event loop shared by all BLE work of a process.
+
+The loop runs on one daemon thread that is started on first use. Synchronous
+code hands coroutines to it with submit (returns a concurrent future) or run
+(blocks for the result), so the BleakClient is connected and written to from
+the same loop.
+"""
+import asyncio
+import atexit
+import threading
+
+_loop = None
+_thread = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """The shared event loop, started lazily."""
+    global _loop, _thread
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def _run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            _thread = threading.Thread(target=_run, name="ems-runtime", daemon=True)
+            _thread.start()
+            started.wait()
+            _loop = loop
+    return _loop
+
+
+def in_runtime():
+    """True when called from the runtime thread itself."""
+    return _thread is not None and threading.current_thread() is _thread
+
+
+def submit(coro, timeout=None):
+    """Schedule coro on the shared loop and return a concurrent.futures.Future.
+
+    With a timeout the coroutine is cancelled on the loop once it runs longer
+    than timeout seconds, and the future raises TimeoutError.
+    """
+    if timeout is not None:
+        coro = asyncio.wait_for(coro, timeout)
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+class Throttle:
+    """submit() for at most limit coroutines on the loop at once.
+
+    The calling thread waits until one of them has finished, so a producer
+    that never waits for its futures is slowed down instead of piling up
+    coroutines on the loop. On the runtime thread itself submit() never
+    waits, it could not finish the coroutines it would wait for.
+    """
+
+    def __init__(self, limit):
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def submit(self, coro, timeout=None):
+        acquired = self._slots.acquire(blocking=not in_runtime())
+        try:
+            future = submit(coro, timeout)
+        except BaseException:
+            coro.close()
+            if acquired:
+                self._slots.release()
+            raise
+        if acquired:
+            future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+def run(coro, timeout=None):
+    """Run coro on the shared loop and block until it is done."""
+    if in_runtime():
+        raise RuntimeError("runtime.run() would block the runtime loop; await the coroutine instead.")
+    return submit(coro, timeout).result()
+
+
+def call_soon(callback, *args):
+    """Call callback on the runtime thread."""
+    return get_loop().call_soon_threadsafe(callback, *args)
+
+
+def shutdown(timeout=5.0):
+    """Cancel pending tasks, stop the loop and join its thread."""
+    global _loop, _thread
+    with _lock:
+        loop, thread = _loop, _thread
+        _loop, _thread = None, None
+    if loop is None or loop.is_closed():
+        return
+
+    async def _cancel_tasks():
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if thread is not threading.current_thread():
+        try:
+            asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result(timeout)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        if not loop.is_running():
+            loop.close()
+    else:
+        loop.stop()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,55 @@
+"""Startup timing per phase, enabled with EMS_STARTUP_TIMING=1.
+
+Entry points import this module first, call mark(phase) at the end of every
+phase and report() once they are ready to use. The first phase, "interpreter",
+is the time from process start to this import where the platform tells it
+(Linux), the others are measured from the previous mark.
+"""
+import os
+import time
+
+ENABLED = os.environ.get("EMS_STARTUP_TIMING", "") not in ("", "0")
+
+_start = time.perf_counter()
+_last = _start
+_phases = []
+
+
+def _process_age():
+    """Seconds since the process started, None where /proc is not available."""
+    try:
+        with open("/proc/self/stat") as f:
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - started_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+if ENABLED:
+    _age = _process_age()
+    if _age is not None:
+        _phases.append(("interpreter", _age * 1000))
+
+
+def mark(phase):
+    """Ends phase, its duration is the time since the previous mark."""
+    global _last
+    if not ENABLED:
+        return
+    now = time.perf_counter()
+    _phases.append((phase, (now - _last) * 1000))
+    _last = now
+
+
+def report(label="ready"):
+    if not ENABLED or not _phases:
+        return
+    total = sum(ms for _, ms in _phases)
+    width = max(len(phase) for phase, _ in _phases)
+    print(f"Startup timing until {label}:")
+    for phase, ms in _phases:
+        print(f"  {phase:<{width}} {ms:8.1f} ms")
+    print(f"  {'total':<{width}} {total:8.1f} ms")
+    _phases.clear()
@@ -0,0 +1,248 @@
+import asyncio
+import re
+import time
+
+from SharedFiles.bluetooth import BluetoothHandler
+from SharedFiles.framing import StateUpdate
+from SharedFiles.log import get_logger
+
+# "O" is parsed as an option without a type by the firmware and ignored
+KEEPALIVE_COMMAND = "O"
+
+_OFF_COMMAND = re.compile(rb"C\d+I\d+T0G")
+
+log = get_logger("supervisor")
+
+
+def is_off_command(payload):
+    """True when every command in payload ends its channel's signal right away (T0)."""
+    if isinstance(payload, StateUpdate):
+        return all(duration == 0 for _, duration in payload.channels.values())
+    parts = payload.split(b"G")[:-1]
+    return bool(parts) and all(_OFF_COMMAND.fullmatch(part + b"G") for part in parts)
+
+
+class ConnectionSupervisor:
+    """Keeps a BluetoothHandler connected and decides what happens to commands during outages.
+
+    A dropped link is noticed through the client's disconnect callback, a failed
+    write or the keepalive, and is followed by reconnect attempts with a backoff
+    that doubles from min_backoff up to max_backoff seconds. While disconnected,
+    commands are held: channel-off commands are always delivered after the
+    reconnect, stimulation is delivered only if it is not older than stale_after
+    seconds by then, otherwise it is dropped and counted in lost_commands.
+    A held send returns within a bounded time even if the link never comes
+    back: stimulation returns False once it is stale_after seconds old, a
+    channel-off returns False after off_timeout seconds but stays held and is
+    still delivered after the reconnect.
+
+    Everything not defined here is forwarded to the wrapped handler.
+    """
+
+    def __init__(self, handler: BluetoothHandler, min_backoff=0.05, max_backoff=2.0, max_attempts=None,
+                 stale_after=0.5, max_held=32, keepalive_interval=2.0, connect_timeout=10.0, off_timeout=5.0):
+        self.handler = handler
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.off_timeout = off_timeout
+        self.max_held = max_held
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+
+        self.reconnects = 0
+        self.failed_reconnects = 0
+        self.lost_commands = 0
+        self.held_delivered = 0
+        self.last_reconnect_ms = None
+        self.reconnect_ms = []
+
+        self._held = []
+        self._reconnect_task = None
+        self._keepalive_task = None
+        self._last_send = 0.0
+        self._closing = False
+        self._delivering = False
+        self._down_since = None
+        handler.disconnect_callbacks.append(self._on_disconnect)
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+    @property
+    def connected(self):
+        return self.handler.client.is_connected and self._reconnect_task is None and not self._delivering
+
+    async def connect(self, timeout=10.0):
+        self._closing = False
+        self.connect_timeout = timeout
+        await self.handler.connect(timeout=timeout)
+        self._last_send = time.monotonic()
+        if self.keepalive_interval and (self._keepalive_task is None or self._keepalive_task.done()):
+            self._keepalive_task = asyncio.get_running_loop().create_task(self._keepalive())
+
+    async def disconnect(self):
+        self._closing = True
+        for task in (self._reconnect_task, self._keepalive_task):
+            if task:
+                task.cancel()
+        self._reconnect_task = None
+        self._keepalive_task = None
+        self._drop_held()
+        if self.handler.client.is_connected:
+            await self.handler.disconnect()
+
+    async def send(self, data, force=False):
+        """Send data, or hold it while reconnecting. Returns False if the command was dropped."""
+        if isinstance(data, StateUpdate):
+            payload = data
+        else:
+            payload = data.encode() if isinstance(data, str) else bytes(data)
+        if self.connected:
+            try:
+                await self.handler.send(payload, force)
+                self._last_send = time.monotonic()
+                return True
+            except (ConnectionError, TimeoutError, OSError) as e:
+                log.warning("Write failed, reconnecting: %s", e)
+                self._link_lost()
+            except Exception as e:
+                # bleak reports a dropped link as BleakError
+                if self.handler.client.is_connected:
+                    raise
+                log.warning("Write failed, reconnecting: %s", e)
+                self._link_lost()
+        return await self._hold(payload, force)
+
+    def submit(self, data, force=False):
+        """send() from any thread, bounded by the wrapped handler's throttle."""
+        return self.handler.throttle.submit(self.send(data, force))
+
+    async def _hold(self, payload, force):
+        if len(self._held) >= self.max_held:
+            self._drop_oldest_stimulation()
+        done = asyncio.get_running_loop().create_future()
+        entry = (time.monotonic(), payload, force, done)
+        self._held.append(entry)
+        if not self._delivering:
+            self._link_lost()
+        off = is_off_command(payload)
+        try:
+            return await asyncio.wait_for(asyncio.shield(done), self.off_timeout if off else self.stale_after)
+        except asyncio.TimeoutError:
+            if not any(held is entry for held in self._held):
+                # Taken out of the backlog and being written right now
+                return await done
+            if off:
+                log.warning("Channel-off still held after %.1f s, it is sent once reconnected.", self.off_timeout)
+                return False
+            self._held = [held for held in self._held if held is not entry]
+            self._lost(done)
+            return False
+
+    def _drop_oldest_stimulation(self):
+        for i, (_, payload, _, done) in enumerate(self._held):
+            if not is_off_command(payload):
+                del self._held[i]
+                self._lost(done)
+                return
+        _, _, _, done = self._held.pop(0)
+        self._lost(done)
+
+    def _lost(self, done):
+        self.lost_commands += 1
+        if not done.done():
+            done.set_result(False)
+
+    def _drop_held(self):
+        held, self._held = self._held, []
+        for _, _, _, done in held:
+            self._lost(done)
+
+    def _on_disconnect(self, handler):
+        if not self._closing:
+            log.warning("Lost connection to %s.", handler.address)
+            self._link_lost()
+
+    def _link_lost(self):
+        if self._reconnect_task is None and not self._closing:
+            self._down_since = time.monotonic()
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        backoff = self.min_backoff
+        attempts = 0
+        try:
+            while not self._closing:
+                attempts += 1
+                try:
+                    await self.handler.connect(timeout=self.connect_timeout)
+                    break
+                except Exception as e:
+                    self.failed_reconnects += 1
+                    log.warning("Reconnect attempt %d failed: %s", attempts, e)
+                    if self.max_attempts is not None and attempts >= self.max_attempts:
+                        log.error("Giving up reconnecting, dropping held commands.")
+                        self._drop_held()
+                        return
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+            self.reconnects += 1
+            self.last_reconnect_ms = (time.monotonic() - self._down_since) * 1000
+            self.reconnect_ms.append(self.last_reconnect_ms)
+            log.info("Reconnected in %.0f ms.", self.last_reconnect_ms)
+        finally:
+            self._reconnect_task = None
+        await self._deliver_held()
+
+    async def _deliver_held(self):
+        # New sends are held as well until the backlog is written, so nothing overtakes it
+        self._delivering = True
+        try:
+            while self._held and not self._closing:
+                queued_at, payload, force, done = self._held.pop(0)
+                if not is_off_command(payload) and time.monotonic() - queued_at > self.stale_after:
+                    self._lost(done)
+                    continue
+                try:
+                    await self.handler.send(payload, force)
+                except Exception:
+                    # Put it back, the next reconnect delivers it
+                    self._held.insert(0, (queued_at, payload, force, done))
+                    self._link_lost()
+                    return
+                self.held_delivered += 1
+                if not done.done():
+                    done.set_result(True)
+        finally:
+            self._delivering = False
+
+    async def _keepalive(self):
+        while not self._closing:
+            await asyncio.sleep(self.keepalive_interval)
+            if self._reconnect_task is not None:
+                continue
+            if not self.handler.client.is_connected:
+                self._link_lost()
+            elif not self._delivering and time.monotonic() - self._last_send >= self.keepalive_interval:
+                try:
+                    await self.handler.send(KEEPALIVE_COMMAND)
+                    self._last_send = time.monotonic()
+                except Exception as e:
+                    log.warning("Keepalive failed, reconnecting: %s", e)
+                    self._link_lost()
+
+    def stats(self):
+        mirror = self.handler.mirror.stats() if self.handler.mirror is not None else {}
+        return {
+            **mirror,
+            "reconnects": self.reconnects,
+            "failed_reconnects": self.failed_reconnects,
+            "last_reconnect_ms": self.last_reconnect_ms,
+            "lost_commands": self.lost_commands,
+            "held_delivered": self.held_delivered,
+            "held": len(self._held),
+            "superseded": self.handler.superseded,
+        }
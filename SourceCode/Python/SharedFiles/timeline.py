@@ -0,0 +1,67 @@
+import asyncio
+
+
+class Timeline:
+    """Sends (offset_ms, command) events at fixed offsets from the start of the run.
+
+    Every deadline is measured from the same monotonic start time, so send latency
+    and late wake-ups on one event do not push back the events after it.
+    """
+
+    def __init__(self, events, send, on_cancel=(), on_event=None):
+        # sorted() is stable, so events with the same offset keep their order
+        self.events = sorted(events, key=lambda event: event[0])
+        self.send = send
+        self.on_cancel = list(on_cancel)
+        # Called as on_event(index, offset_ms, command) after each event was dispatched
+        self.on_event = on_event
+        self.jitter_ms = []
+        self.cancelled = False
+        self._task = None
+        # Estimated oversleep of the loop, used to wake up slightly before each deadline
+        self._lead = 0.0
+
+    async def run(self):
+        self._task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        sends = []
+        try:
+            for offset_ms, command in self.events:
+                deadline = start + offset_ms / 1000
+                await self._sleep_until(loop, deadline)
+                self.jitter_ms.append((loop.time() - deadline) * 1000)
+                # Sends are not awaited here, so a slow write cannot delay the next deadline
+                sends.append(asyncio.ensure_future(self.send(command)))
+                if self.on_event:
+                    self.on_event(len(sends) - 1, offset_ms, command)
+            await asyncio.gather(*sends)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            for command in self.on_cancel:
+                await self.send(command)
+            raise
+        return self
+
+    async def _sleep_until(self, loop, deadline):
+        delay = deadline - loop.time() - self._lead
+        if delay > 0:
+            await asyncio.sleep(delay)
+            overshoot = loop.time() - (deadline - self._lead)
+            self._lead = max(0.0, 0.8 * self._lead + 0.2 * overshoot)
+        # Short cooperative spin for the remainder of the lead time
+        while loop.time() < deadline:
+            await asyncio.sleep(0)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.get_loop().call_soon_threadsafe(self._task.cancel)
+
+    def report(self):
+        return [
+            {"offset_ms": offset_ms, "command": command, "jitter_ms": round(jitter, 3)}
+            for (offset_ms, command), jitter in zip(self.events, self.jitter_ms)
+        ]
+
+    def max_jitter_ms(self):
+        return max((abs(j) for j in self.jitter_ms), default=0.0)
@@ -0,0 +1,75 @@
+from SharedFiles import startup
+import argparse
+import json
+import os
+
+from SharedFiles import participants, runtime
+from SharedFiles.fanout import supervised_handler
+from StudyRunner.runner import LiveParticipant, ScriptedParticipant, load_protocol, participant_seed, run_sessions
+
+startup.mark("imports")
+
+DEFAULT_PROTOCOL = os.path.join(os.path.dirname(__file__), "protocol.json")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run study sessions without interaction, several at once.")
+    parser.add_argument("protocol", nargs="?", default=DEFAULT_PROTOCOL, help="study protocol (JSON)")
+    parser.add_argument("--sessions", type=int, default=1, help="number of emulated sessions")
+    parser.add_argument("--address", help="comma separated toolkit addresses, one session each "
+                                          "(default: emulated devices)")
+    parser.add_argument("--responses", choices=("scripted", "live"), default="scripted",
+                        help="scripted participants or answers typed on the console")
+    parser.add_argument("--accuracy", type=float, default=0.9, help="share of right answers when scripted")
+    parser.add_argument("--seed", type=int, help="overrides the seed of the protocol")
+    parser.add_argument("--participant", help="use the stored calibration of this participant")
+    parser.add_argument("--report", help="write the full report to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    protocol = load_protocol(args.protocol)
+    addresses = [a.strip() for a in args.address.split(",")] if args.address else \
+        [f"EMU:session{i}" for i in range(args.sessions)]
+    if args.responses == "live" and len(addresses) > 1:
+        # Concurrent sessions would all prompt on the same console at once
+        print("Live responses need a single session.")
+        return
+    handlers = {f"session{i}": supervised_handler(address) for i, address in enumerate(addresses)}
+    startup.mark("protocol")
+    startup.report("sessions start")
+
+    intensities = (100, 100)
+    calibration = participants.calibration(args.participant) if args.participant else None
+    if calibration:
+        intensities = (calibration.get(0, 100), calibration.get(1, 100))
+
+    if args.responses == "live":
+        def responder(index):
+            return LiveParticipant()
+    else:
+        seed = protocol.get("seed", 0) if args.seed is None else args.seed
+
+        def responder(index):
+            return ScriptedParticipant(args.accuracy, seed=participant_seed(seed, index))
+
+    try:
+        report = runtime.run(run_sessions(handlers, protocol, responder, args.seed, intensities))
+    finally:
+        runtime.shutdown()
+
+    print(f"{len(handlers)} session(s) in {report['wall_s']} s")
+    for session in report["sessions"]:
+        if "error" in session:
+            print(f"{session['session']}: failed, {session['error']}")
+            continue
+        print(f"{session['session']}: {session['correct']}/{session['trials']} correct in {session['duration_s']} s, "
+              f"jitter p99 {session['jitter_ms'].get('p99')} ms, max overrun {session['overrun_ms'].get('max')} ms")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Non-interactive study sessions, many at once on the shared runtime loop.
+
+A protocol is a JSON file like protocol.json:
+  seed:     randomisation seed, session i shuffles with seed + i
+  pause_ms: rest after each answer
+  blocks:   [{"type": "zone" | "flow" | "crossfade", "conditions": [...], "repetitions": n}]
+Each block plays its conditions repetitions times in shuffled order, with the
+same stimuli as StudyTests (zone_events / flow_events / crossfade_events).
+Crossfade blocks are an opt-in variant of the flows, not part of the original
+study. Answers come from a responder, awaited as
+respond(session, trial) -> answered condition.
+"""
+import asyncio
+import json
+import random
+import time
+
+from SharedFiles.framing import StateUpdate
+from SharedFiles.log import get_logger
+from SharedFiles.timeline import Timeline
+from StudyTests.tests import crossfade_events, flow_events, zone_events
+
+BLOCKS = {"zone": zone_events, "flow": flow_events, "crossfade": crossfade_events}
+CONDITIONS = {"zone": (1, 2, 3), "flow": (1, 2), "crossfade": (1, 2)}
+
+log = get_logger("study_runner")
+
+
+def load_protocol(path):
+    with open(path) as f:
+        protocol = json.load(f)
+    for block in protocol.get("blocks", []):
+        if block.get("type") not in BLOCKS:
+            raise ValueError(f"Unknown block type {block.get('type')!r}, expected one of {sorted(BLOCKS)}.")
+        unknown = set(block.get("conditions", CONDITIONS[block["type"]])) - set(CONDITIONS[block["type"]])
+        if unknown:
+            raise ValueError(f"Unknown {block['type']} condition(s) {sorted(unknown)}.")
+    return protocol
+
+
+def trial_order(protocol, seed):
+    """[(block type, condition)] of one session, shuffled within each block."""
+    rng = random.Random(seed)
+    trials = []
+    for block in protocol["blocks"]:
+        kind = block["type"]
+        order = list(block.get("conditions", CONDITIONS[kind])) * block.get("repetitions", 1)
+        rng.shuffle(order)
+        trials += [(kind, condition) for condition in order]
+    return trials
+
+
+def participant_seed(seed, index):
+    """Seed of the scripted answers of session index, independent of its trial order seed."""
+    return f"participant:{seed + index}"
+
+
+class ScriptedParticipant:
+    """Names the right condition with probability accuracy, after a random delay."""
+
+    def __init__(self, accuracy=0.9, delay_ms=(800, 2000), seed=None):
+        self.accuracy = accuracy
+        self.delay_ms = delay_ms
+        self.random = random.Random(seed)
+
+    async def __call__(self, session, trial):
+        kind, condition = trial
+        await asyncio.sleep(self.random.uniform(*self.delay_ms) / 1000)
+        if self.random.random() < self.accuracy:
+            return condition
+        return self.random.choice([c for c in CONDITIONS[kind] if c != condition])
+
+
+class LiveParticipant:
+    """Asks on the console, without blocking the loop the other sessions run on.
+
+    There is only one console, so this is for a single session at a time.
+    """
+
+    async def __call__(self, session, trial):
+        kind, _ = trial
+        choices = "/".join(str(c) for c in CONDITIONS[kind])
+        answer = await asyncio.get_running_loop().run_in_executor(
+            None, input, f"[{session}] Which {kind} was it ({choices})? ")
+        try:
+            return int(answer)
+        except ValueError:
+            return None
+
+
+def _stats(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(values[len(values) // 2], 3),
+        "p99": round(values[min(len(values) - 1, int(len(values) * 0.99))], 3),
+        "max": round(values[-1], 3),
+    }
+
+
+async def run_session(name, handler, protocol, respond, seed, intensities=(100, 100)):
+    """Plays every trial of protocol on handler and returns the session report."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    pause = protocol.get("pause_ms", 0) / 1000
+    jitter, overrun, response_ms, answers = [], [], [], []
+    for trial in trial_order(protocol, seed):
+        kind, condition = trial
+        timeline = Timeline(BLOCKS[kind](condition, *intensities), handler.send, on_cancel=[StateUpdate.off()])
+        planned = timeline.events[-1][0] / 1000
+        begin = loop.time()
+        await timeline.run()
+        # How much longer than planned the stimulus took, including the last write
+        overrun.append((loop.time() - begin - planned) * 1000)
+        jitter += [abs(j) for j in timeline.jitter_ms]
+
+        asked = loop.time()
+        answer = await respond(name, trial)
+        response_ms.append((loop.time() - asked) * 1000)
+        answers.append({"type": kind, "condition": condition, "answer": answer})
+        log.debug("%s: %s %s answered %s", name, kind, condition, answer)
+        await asyncio.sleep(pause)
+
+    return {
+        "session": name,
+        "seed": seed,
+        "trials": len(answers),
+        "correct": sum(a["answer"] == a["condition"] for a in answers),
+        "duration_s": round(loop.time() - started, 3),
+        "jitter_ms": _stats(jitter),
+        "overrun_ms": _stats(overrun),
+        "response_ms": _stats(response_ms),
+        "answers": answers,
+    }
+
+
+async def run_sessions(handlers, protocol, responder_factory, seed=None, intensities=(100, 100)):
+    """Connects {name: handler} and runs one session on each of them at the same time.
+
+    responder_factory(index) returns the responder of a session. A session
+    that fails is reported with its error and does not stop the others.
+    """
+    seed = protocol.get("seed", 0) if seed is None else seed
+
+    async def _session(index, name, handler):
+        try:
+            await handler.connect(timeout=10.0)
+            return await run_session(name, handler, protocol, responder_factory(index), seed + index, intensities)
+        except Exception as e:
+            log.warning("Session %s failed: %s", name, e)
+            return {"session": name, "seed": seed + index, "error": str(e)}
+        finally:
+            await handler.disconnect()
+
+    started = time.perf_counter()
+    reports = await asyncio.gather(*(_session(i, name, handler) for i, (name, handler) in enumerate(handlers.items())))
+    return {"wall_s": round(time.perf_counter() - started, 3), "sessions": list(reports)}
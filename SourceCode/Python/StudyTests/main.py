@@ -1,27 +1,48 @@
-import asyncio
+from SharedFiles import startup
+import os
 
 from StudyTests.tests import start_tests
-from SharedFiles.bluetooth import BluetoothHandler
+from SharedFiles import participants, runtime
+from SharedFiles.fanout import create_handler
 
-# Replace with Toolkit address
-DEVICE_ADDRESS = "DFA6C7B9-4E47-88B8-0E82-3A420A1C3FDD"
+startup.mark("imports")
+
+# Replace with Toolkit address, or set EMS_DEVICE_ADDRESS (e.g. "EMU:0" for the emulator).
+# Several comma separated addresses drive all toolkits at once.
+DEVICE_ADDRESS = os.environ.get("EMS_DEVICE_ADDRESS", "DFA6C7B9-4E47-88B8-0E82-3A420A1C3FDD")
 
 CHANNEL1_INTENSITY = 100
 CHANNEL2_INTENSITY = 100
-
-async def main():
-    handler = BluetoothHandler(DEVICE_ADDRESS)
+# Uses the stored calibration of this participant when set
+PARTICIPANT = os.environ.get("EMS_PARTICIPANT")
+
+def main():
+    handler = create_handler(DEVICE_ADDRESS)
+    intensities = {0: CHANNEL1_INTENSITY, 1: CHANNEL2_INTENSITY}
+    if PARTICIPANT:
+        calibration = participants.calibration(PARTICIPANT)
+        if calibration:
+            intensities.update(calibration)
+            print(f"Using calibration of {PARTICIPANT}: {calibration}")
+        else:
+            print(f"No calibration stored for {PARTICIPANT}, using defaults.")
 
     try:
         print(f"Connecting to {DEVICE_ADDRESS}...")
-        await handler.connect(timeout=10.0)
-        print(f"Connected. Writable characteristic: {handler.characteristic_uuid}")
+        runtime.run(handler.connect(timeout=10.0))
+        print(f"Connected to {DEVICE_ADDRESS}.")
+        startup.mark("connect")
+        startup.report()
 
-        start_tests(handler, CHANNEL1_INTENSITY, CHANNEL2_INTENSITY)
+        start_tests(handler, intensities[0], intensities[1])
 
     except Exception as e:
         print("Connection Failed: " + str(e))
+    finally:
+        print("Connection stats: " + str(handler.stats()))
+        runtime.run(handler.disconnect(), timeout=5.0)
+        runtime.shutdown()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
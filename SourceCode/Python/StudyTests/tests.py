@@ -1,27 +1,32 @@
-import threading
 import random
-import asyncio
-from time import sleep
 
+from SharedFiles import metrics, patterns, runtime
 from SharedFiles.bluetooth import BluetoothHandler
+from SharedFiles.framing import StateUpdate
+from SharedFiles.timeline import Timeline
 
-def start_background_loop():
-    loop = asyncio.new_event_loop()
-    def _run():
-        asyncio.set_event_loop(loop)
-        loop.run_forever()
-    threading.Thread(target=_run, daemon=True).start()
-    return loop
+def ble_send(ble_handler, message):
+    return metrics.submit_send(ble_handler, message)
 
-bg_loop = start_background_loop()
 
-def ble_send(ble_handler, message):
-    asyncio.run_coroutine_threadsafe(ble_handler.send(message), bg_loop)
+def ble_play(ble_handler, events):
+    timeline = Timeline(events, ble_handler.send, on_cancel=[StateUpdate.off()])
+    future = runtime.submit(timeline.run())
+    try:
+        future.result()
+    except KeyboardInterrupt:
+        # Stops the sequence and turns both channels off
+        future.cancel()
+        raise
+    print("Max timing error: " + str(round(timeline.max_jitter_ms(), 2)) + " ms")
+    return timeline
 
 
 def start_tests(ble_handler : BluetoothHandler, channel1_intensity=100, channel2_intensity=100):
     print("##### STUDY #####")
     print("Please set the correct intensities for both channels on the EMS device.")
+    # Compiled now, so every stimulus starts without delay
+    patterns.precompile({0: channel1_intensity, 1: channel2_intensity})
     start = input("Press Enter to start the study...")
 
     test_single_points(ble_handler, channel1_intensity, channel2_intensity)
@@ -48,24 +53,12 @@ def test_single_points(ble_handler : BluetoothHandler, channel1_intensity, chann
             match zone:
                 case 1:
                     print("Testing Channel 1")
-                    ble_send(ble_handler, "C1I0T0G")
-                    ble_send(ble_handler, "C0I" + str(channel1_intensity) +"T30000G")
-                    sleep(5)
-                    turn_off_channels(ble_handler)
-
                 case 2:
                     print("Testing Middle")
-                    ble_send(ble_handler, "C0I" + str(channel1_intensity) +"T30000G")
-                    ble_send(ble_handler, "C1I" + str(channel2_intensity) +"T30000G")
-                    sleep(5)
-                    turn_off_channels(ble_handler)
-
                 case 3:
                     print("Testing Channel 2")
-                    ble_send(ble_handler, "C0I0T0G")
-                    ble_send(ble_handler, "C1I" + str(channel2_intensity) +"T30000G")
-                    sleep(5)
-                    turn_off_channels(ble_handler)
+
+            ble_play(ble_handler, zone_events(zone, channel1_intensity, channel2_intensity))
 
             again = input("Press Enter to continue or type 'again' to rerun the current test...")
             if again != "again":
@@ -92,26 +85,10 @@ def test_flow_directions(ble_handler: BluetoothHandler, channel1_intensity, chan
             match flow:
                 case 1:
                     print("Testing Channel 1 to Channel 2")
-                    ble_send(ble_handler, "C1I0T0G")
-                    ble_send(ble_handler, "C0I" + str(channel1_intensity) + "T30000G")
-                    sleep(3)
-                    ble_send(ble_handler, "C1I" + str(channel2_intensity) + "T30000G")
-                    sleep(3)
-                    ble_send(ble_handler, "C0I0T0G")
-                    sleep(3)
-                    ble_send(ble_handler, "C1I0T0G")
-
                 case 2:
                     print("Testing Channel 2 to Channel 1")
-                    ble_send(ble_handler, "C0I0T0G")
-                    ble_send(ble_handler, "C1I" + str(channel2_intensity) + "T30000G")
-                    sleep(3)
-                    ble_send(ble_handler, "C0I" + str(channel1_intensity) + "T30000G")
-                    sleep(3)
-                    ble_send(ble_handler, "C1I0T0G")
-                    sleep(3)
-                    ble_send(ble_handler, "C0I0T0G")
 
+            ble_play(ble_handler, flow_events(flow, channel1_intensity, channel2_intensity))
 
             again = input("Press Enter to continue or type 'again' to rerun the current test...")
             if again != "again":
@@ -119,7 +96,30 @@ def test_flow_directions(ble_handler: BluetoothHandler, channel1_intensity, chan
 
     print("All flow tests completed!")
 
+
+def zone_events(zone, channel1_intensity, channel2_intensity):
+    # Zone 1 = Channel 1, zone 2 = both channels, zone 3 = Channel 2, 5 s each
+    if zone not in (1, 2, 3):
+        raise ValueError("Unknown zone: " + str(zone))
+    return patterns.compile_pattern(patterns.COMMON[f"zone{zone}"], {0: channel1_intensity, 1: channel2_intensity})
+
+
+def flow_events(flow, channel1_intensity, channel2_intensity):
+    # First channel 0-6 s, second channel 3-9 s, overlapping in the middle
+    if flow not in (1, 2):
+        raise ValueError("Unknown flow: " + str(flow))
+    return patterns.compile_pattern(patterns.COMMON[f"flow{flow}"], {0: channel1_intensity, 1: channel2_intensity})
+
+
+def crossfade_events(direction, channel1_intensity, channel2_intensity):
+    # Not part of the original study: 3 s on the first channel, a 3 s equal-power crossfade, 3 s on the second
+    if direction not in (1, 2):
+        raise ValueError("Unknown crossfade: " + str(direction))
+    return patterns.compile_pattern(patterns.COMMON[f"crossfade{direction}"],
+                                    {0: channel1_intensity, 1: channel2_intensity})
+
+
 def turn_off_channels(ble_handler: BluetoothHandler):
-    ble_send(ble_handler, "C0I0T0G")
-    ble_send(ble_handler, "C1I0T0G")
+    # Not forced, skipped when the handler knows both channels are off already
+    return ble_send(ble_handler, StateUpdate.off(force=False))
 